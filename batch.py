@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+""" Headless batch booking
+
+Runs booking jobs read from a JSONL file without the interactive menu, so
+bookings can be made for many users at once. Each line is one job:
+
+    {"id": "smith", "action": "reserve-earliest",
+     "tokens": {"hotel": "...", "band": "..."},
+     "constraints": {"after": 10, "before": 120, "exclude": [42]}}
+
+Actions:
+
+    reserve-earliest  book the earliest matching slot that meets the
+                      constraints, trying later ones if it is taken
+    reserve-specific  book "slot" on every service
+    cancel            release "slot" on every service, or every held slot
+                      if no slot is given
+    upgrade-until     starting from the held "slot", keep moving to an
+                      earlier matching slot until "target" is reached or
+                      "timeout" seconds have passed
+
+Providers and client settings come from the config file (api.ini by
+default); a job's tokens replace the configured keys, and a provider the
+job gives no token for is booked with the configured key. Jobs run on a
+bounded pool of workers. Requests are rate limited per service and token,
+and jobs sharing a token run one at a time so they cannot race each other
+past the reservation limit. One result line is written per job as it
+finishes:
+
+    python3 batch.py jobs.jsonl --out results.jsonl --workers 8
+"""
+
+import argparse
+import asyncio
+import configparser
+import json
+import sys
+import time
+
+from cache import ResponseCache
+from matching import MatchingIndex
+from metrics import Metrics
+from reservationapi import AsyncReservationApi, endpoint_timeouts
+
+ACTIONS = ("reserve-earliest", "reserve-specific", "cancel", "upgrade-until")
+
+
+class JobError(Exception):
+    """A job that cannot be run as written"""
+
+
+class JobInputError(JobError, ValueError):
+    """A job with a missing or malformed field"""
+
+
+def allowed(slot_id: int, constraints: dict) -> bool:
+    """Whether slot_id meets a job's constraints"""
+    return (slot_id >= constraints.get("after", 0)
+            and slot_id <= constraints.get("before", slot_id)
+            and slot_id not in constraints.get("exclude", ()))
+
+
+class BatchRunner:
+    def __init__(self, config: configparser.ConfigParser, workers: int = 4,
+                 metrics: Metrics = None):
+        """ Create a runner for the providers declared in config.
+
+        Args:
+            config: The parsed api.ini, with a section (url and key) for
+                each provider and client settings in [global].
+            workers: The number of jobs to run at once.
+            metrics: A Metrics to report every job's requests to.
+        """
+        self.config    = config
+        self.settings  = config['global']
+        self.workers   = workers
+        self.metrics   = metrics
+        self.providers = [section for section in config.sections()
+                          if 'url' in config[section] and 'key' in config[section]]
+        self.max_holds = self.settings.getint('max_holds', fallback=2)
+        self.cache = ResponseCache(
+            maxsize=self.settings.getint('cache_size', fallback=128),
+            ttls={"/reservation/available": self.settings.getfloat('ttl_available', fallback=2.0),
+                  "/reservation": self.settings.getfloat('ttl_held', fallback=2.0)},
+            metrics=metrics)
+        self._clients = {}
+        self._locks   = {}
+
+    def client(self, provider: str, token: str) -> AsyncReservationApi:
+        """The client for provider and token, shared by every job using
+        that token so its connections stay warm"""
+        key = (provider, token)
+        if key not in self._clients:
+            settings = self.settings
+            self._clients[key] = AsyncReservationApi(
+                self.config[provider]['url'],
+                token,
+                int(settings['retries']),
+                float(settings['delay']),
+                pool_size=settings.getint('pool_size', fallback=4),
+                connect_timeout=settings.getfloat('connect_timeout', fallback=3.05),
+                read_timeout=settings.getfloat('read_timeout', fallback=10.0),
+                rate=settings.getfloat('rate', fallback=1.0),
+                headroom=settings.getfloat('rate_headroom', fallback=0.1),
+                backoff_max=settings.getfloat('backoff_max', fallback=8.0),
+                failure_threshold=settings.getint('failure_threshold', fallback=5),
+                reset_timeout=settings.getfloat('reset_timeout', fallback=30.0),
+                timeouts=endpoint_timeouts(settings),
+                deadline=settings.getfloat('deadline', fallback=0) or None,
+                hedge_percentile=settings.getfloat('hedge_percentile', fallback=0) or None,
+                cache=self.cache,
+                metrics=self.metrics)
+        return self._clients[key]
+
+    def services(self, job: dict) -> list:
+        """(provider, client) pairs for every provider, using the job's
+        tokens where it has them"""
+        tokens = job.get("tokens", {})
+        unknown = set(tokens) - set(self.providers)
+        if unknown:
+            raise JobError(f"unknown providers: {', '.join(sorted(unknown))}")
+        return [(name, self.client(name, tokens.get(name, self.config[name]['key'])))
+                for name in self.providers]
+
+    async def close(self):
+        for api in self._clients.values():
+            await api.close()
+
+    async def reserve_all(self, services: list, slot_id: int) -> dict:
+        """Reserve slot_id on every service, releasing the holds made if
+        any fails. Returns the error for each service that failed."""
+        results = await asyncio.gather(
+            *(api.reserve_slot(str(slot_id)) for _, api in services),
+            return_exceptions=True)
+        errors = {name: result for (name, _), result in zip(services, results)
+                  if isinstance(result, Exception)}
+        if errors:
+            await asyncio.gather(
+                *(api.release_slot(str(slot_id)) for (_, api), result
+                  in zip(services, results) if not isinstance(result, Exception)),
+                return_exceptions=True)
+        return errors
+
+    async def release_all(self, services: list, slot_id: int) -> dict:
+        """Release slot_id on every service, returning the error for each
+        service that failed"""
+        results = await asyncio.gather(
+            *(api.release_slot(str(slot_id)) for _, api in services),
+            return_exceptions=True)
+        return {name: result for (name, _), result in zip(services, results)
+                if isinstance(result, Exception)}
+
+    async def matching(self, services: list, constraints: dict) -> list:
+        """Every matching slot that meets constraints, earliest first"""
+        index = MatchingIndex([name for name, _ in services])
+        available = await asyncio.gather(
+            *(api.get_slot_ids_available() for _, api in services))
+        for (name, _), slots in zip(services, available):
+            index.update(name, slots)
+        return [slot_id for slot_id in index.top(len(index))
+                if allowed(slot_id, constraints)]
+
+    async def check_limit(self, services: list):
+        """Raise JobError if a service's reservation limit leaves no room
+        for another hold"""
+        held = await asyncio.gather(*(api.get_slots_held() for _, api in services))
+        full = [name for (name, _), slots in zip(services, held)
+                if len(slots) >= self.max_holds]
+        if full:
+            raise JobError(f"reservation limit ({self.max_holds}) reached with "
+                           f"{', '.join(full)}")
+
+    async def reserve_earliest(self, job: dict, services: list) -> dict:
+        constraints = job_constraints(job)
+        await self.check_limit(services)
+        errors = {}
+        for attempt, slot_id in enumerate(await self.matching(services, constraints)):
+            if attempt == number_field(job, "attempts", 3):
+                break
+            errors = await self.reserve_all(services, slot_id)
+            if not errors:
+                return {"slot": slot_id, "attempts": attempt + 1}
+        raise JobError(f"no matching slot could be reserved{describe(errors)}")
+
+    async def reserve_specific(self, job: dict, services: list) -> dict:
+        slot_id = slot_field(job, "slot")
+        await self.check_limit(services)
+        errors = await self.reserve_all(services, slot_id)
+        if errors:
+            raise JobError(f"slot {slot_id} could not be reserved{describe(errors)}")
+        return {"slot": slot_id}
+
+    async def cancel(self, job: dict, services: list) -> dict:
+        if "slot" in job:
+            slot_id = slot_field(job, "slot")
+            errors = await self.release_all(services, slot_id)
+            if errors:
+                raise JobError(f"release failed{describe(errors)}")
+            return {"released": [slot_id]}
+
+        held = await asyncio.gather(*(api.get_slots_held() for _, api in services))
+        released = await asyncio.gather(
+            *(api.release_many(slot["id"] for slot in slots)
+              for (_, api), slots in zip(services, held)))
+        errors = {f"{name} slot {slot_id}": result
+                  for (name, _), results in zip(services, released)
+                  for slot_id, result in results.items() if isinstance(result, Exception)}
+        if errors:
+            raise JobError(f"release failed{describe(errors)}")
+        return {"released": sorted({slot["id"] for slots in held for slot in slots})}
+
+    async def upgrade_step(self, services: list, current: int, constraints: dict):
+        """Move from slot current to the earliest matching slot before it,
+        returning the new slot, or None if there was none to move to"""
+        better = next((slot_id for slot_id in await self.matching(services, constraints)
+                       if slot_id < current), None)
+        if better is None or await self.reserve_all(services, better):
+            return None
+        errors = await self.release_all(services, current)
+        if errors:
+            raise JobError(f"upgraded to {better} but slot {current} "
+                           f"was not released{describe(errors)}")
+        return better
+
+    async def upgrade_until(self, job: dict, services: list) -> dict:
+        current = slot_field(job, "slot")
+        target = slot_field(job, "target", 1)
+        deadline = time.monotonic() + number_field(job, "timeout", 60)
+        interval = self.settings.getfloat('upgrade_min_interval', fallback=2.0)
+        constraints = job_constraints(job)
+        upgrades = 0
+        while current > target and time.monotonic() < deadline:
+            better = await self.upgrade_step(services, current, constraints)
+            if better is not None:
+                current, upgrades = better, upgrades + 1
+                continue
+            await asyncio.sleep(min(interval, max(0.0, deadline - time.monotonic())))
+        return {"slot": current, "upgrades": upgrades, "reached": current <= target}
+
+    async def run_job(self, job: dict) -> dict:
+        """Run one job, returning its result line"""
+        if not isinstance(job, dict):
+            raise JobInputError(f"not a JSON object: {job!r}")
+        if "invalid" in job:
+            raise JobInputError(job["invalid"])
+        action = job.get("action")
+        handler = {"reserve-earliest": self.reserve_earliest,
+                   "reserve-specific": self.reserve_specific,
+                   "cancel": self.cancel,
+                   "upgrade-until": self.upgrade_until}.get(action)
+        if handler is None:
+            raise JobError(f"unknown action {action!r}, expected one of {', '.join(ACTIONS)}")
+        services = self.services(job)
+        # Jobs sharing a token wait for each other, taking the locks in a
+        # fixed order so two jobs cannot each hold one the other needs
+        locks = [self._locks.setdefault(key, asyncio.Lock())
+                 for key in sorted((name, api.token) for name, api in services)]
+        for lock in locks:
+            await lock.acquire()
+        try:
+            return await handler(job, services)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    async def run(self, jobs, out):
+        """Run every job in jobs on the worker pool, writing one JSON line
+        per job to out as it finishes. Returns (succeeded, failed)."""
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        counts = [0, 0]
+
+        async def worker():
+            while True:
+                line, job, queued = await queue.get()
+                started = time.monotonic()
+                result = {"line": line, "id": line, "action": None}
+                try:
+                    if isinstance(job, dict):
+                        result.update(id=job.get("id", line), action=job.get("action"))
+                    result.update(await self.run_job(job))
+                    result["ok"] = True
+                except Exception as e:
+                    result["ok"] = False
+                    result["error"] = f"{type(e).__name__}: {e}"
+                finally:
+                    finished = time.monotonic()
+                    result["queued"]  = round(started - queued, 6)
+                    result["elapsed"] = round(finished - started, 6)
+                    # A worker that stopped here would leave join() waiting
+                    # forever, so whatever happens the job is done
+                    try:
+                        out.write(json.dumps(result) + "\n")
+                        out.flush()
+                    finally:
+                        counts[not result.get("ok")] += 1
+                        queue.task_done()
+
+        tasks = [asyncio.ensure_future(worker()) for _ in range(self.workers)]
+        try:
+            for line, job in jobs:
+                await queue.put((line, job, time.monotonic()))
+            await queue.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.close()
+        return tuple(counts)
+
+
+def as_slot_id(value, field: str) -> int:
+    """value (an int or a string of digits) as a slot ID, raising
+    JobInputError naming field if it is anything else"""
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise JobInputError(f"{field!r} must be a slot ID, not {value!r}")
+    return value
+
+
+def slot_field(job: dict, field: str, default: int = None) -> int:
+    """job[field] as a slot ID, or default if it is missing. Raises
+    JobInputError if it is missing with no default or not a slot ID."""
+    value = job.get(field, default)
+    if value is None:
+        raise JobInputError(f"{job.get('action')} needs a {field!r}")
+    return as_slot_id(value, field)
+
+
+def number_field(job: dict, field: str, default: float) -> float:
+    """job[field] as a number, or default if it is missing"""
+    value = job.get(field, default)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise JobInputError(f"{field!r} must be a number, not {value!r}") from None
+
+
+def job_constraints(job: dict) -> dict:
+    """A job's constraints with every slot ID checked and converted"""
+    constraints = job.get("constraints", {})
+    if not isinstance(constraints, dict):
+        raise JobInputError(f"'constraints' must be an object, not {constraints!r}")
+    checked = {name: as_slot_id(constraints[name], name)
+               for name in ("after", "before") if name in constraints}
+    exclude = constraints.get("exclude", [])
+    if not isinstance(exclude, list):
+        raise JobInputError(f"'exclude' must be a list of slot IDs, not {exclude!r}")
+    checked["exclude"] = {as_slot_id(slot_id, "exclude") for slot_id in exclude}
+    return checked
+
+
+def describe(errors: dict) -> str:
+    """Format per-service errors for a result line"""
+    if not errors:
+        return ""
+    return ": " + "; ".join(f"{name} {type(e).__name__}: {e}" for name, e in errors.items())
+
+
+def read_jobs(lines):
+    """Yield (line number, job) for each job in a JSONL stream, skipping
+    blank lines. A line that is not a JSON object becomes a job that fails."""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            job = {"invalid": f"not valid JSON: {e}"}
+        else:
+            if not isinstance(job, dict):
+                job = {"invalid": f"not a JSON object: {line.strip()[:80]}"}
+        yield number, job
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run booking jobs from a JSONL file")
+    parser.add_argument("jobs", help="JSONL file of jobs, or - for stdin")
+    parser.add_argument("--out", default="-", help="JSONL results file, or - for stdout")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--config", default="api.ini")
+    parser.add_argument("--metrics", help="Write request metrics as JSON to this file")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    metrics = Metrics() if args.metrics else None
+    runner = BatchRunner(config, workers=args.workers, metrics=metrics)
+
+    jobs_file = sys.stdin if args.jobs == "-" else open(args.jobs)
+    out = sys.stdout if args.out == "-" else open(args.out, "w")
+    start = time.monotonic()
+    try:
+        succeeded, failed = asyncio.run(runner.run(read_jobs(jobs_file), out))
+    finally:
+        if jobs_file is not sys.stdin:
+            jobs_file.close()
+        if out is not sys.stdout:
+            out.close()
+    if metrics is not None:
+        with open(args.metrics, "w") as f:
+            f.write(metrics.to_json())
+    print(f"{succeeded} jobs succeeded, {failed} failed in "
+          f"{time.monotonic() - start:.1f}s", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+""" Benchmarks for the booking flows
+
+Runs the client against a local SimulatedServer and measures:
+
+    send_request     requests per second through the menu's
+                     AsyncReservationApi, one after another
+    time_to_book     p50/p95/p99 seconds to reserve a slot on both services
+    rollback         p50/p95/p99 seconds for a booking the band refuses
+                     to end with the hotel hold released again
+    upgrade_detect   p50/p95/p99 seconds from a better slot appearing to
+                     the background monitor holding it
+    matching_N       CPU seconds to index and update matching slots with N
+                     slots per provider, for N from 10^2 up to --max-slots,
+                     with the sorted and bitmap indexes (the fastest of
+                     --repeat or more runs, as single runs are too noisy
+                     to compare)
+
+Results are written as JSON. With --compare, each metric is checked
+against a stored baseline and the run fails if any got worse by more
+than --threshold. Time differences under --floor seconds are ignored,
+since they are within timer and scheduling noise.
+
+    python3 bench.py --out baseline.json
+    python3 bench.py --out current.json --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from matching import BitmapIndex, MatchingIndex
+from simserver import SimulatedServer
+
+
+def percentiles(samples: list, prefix: str) -> dict:
+    """p50/p95/p99 of samples, keyed as prefix.pNN"""
+    samples = sorted(samples)
+    result = {}
+    for p in (50, 95, 99):
+        index = min(len(samples) - 1, round(p / 100 * (len(samples) - 1)))
+        result[f"{prefix}.p{p}"] = samples[index] if samples else None
+    return result
+
+
+def load_booking(server: SimulatedServer):
+    """Import booking.py configured to talk to server without rate limits"""
+    config = tempfile.NamedTemporaryFile("w", suffix=".ini", delete=False)
+    config.write(f"""[hotel]
+url = {server.url('hotel')}
+key = bench-hotel
+
+[band]
+url = {server.url('band')}
+key = bench-band
+
+[global]
+retries = 3
+delay   = 0.01
+rate    = 100000
+ttl_available = 0
+ttl_held      = 0
+upgrade_min_interval = 0.05
+upgrade_max_interval = 0.05
+""")
+    config.close()
+    os.environ["BOOKING_CONFIG"] = config.name
+    try:
+        import booking
+    finally:
+        # booking reads its config once, on import
+        os.unlink(config.name)
+        del os.environ["BOOKING_CONFIG"]
+    return booking
+
+
+def bench_send_request(booking, requests: int) -> dict:
+    api = booking.services[0][1]
+
+    async def send():
+        for _ in range(requests):
+            await api.get_slots_held()
+
+    start = time.perf_counter()
+    booking.run(send())
+    elapsed = time.perf_counter() - start
+    return {"send_request.rps": requests / elapsed}
+
+
+def bench_time_to_book(booking, server, rounds: int) -> dict:
+    quiet = lambda *args: None
+    samples = []
+    for n in range(rounds):
+        slot_id = n % 50 + 1
+        start = time.perf_counter()
+        booked = booking.run(booking.reserve_all(slot_id, quiet))
+        samples.append(time.perf_counter() - start)
+        if booked:
+            booking.run(booking.release_on(slot_id, booking.services, "", quiet))
+    return percentiles(samples, "time_to_book")
+
+
+def bench_rollback(booking, server, rounds: int) -> dict:
+    quiet = lambda *args: None
+    band = server.providers["band"]
+    samples = []
+    for n in range(rounds):
+        slot_id = n % 50 + 1
+        # Someone else has the band, so the hotel hold must be rolled back
+        with band.lock:
+            band.holds[slot_id] = "someone-else"
+        start = time.perf_counter()
+        booked = booking.run(booking.reserve_all(slot_id, quiet))
+        samples.append(time.perf_counter() - start)
+        assert not booked and slot_id not in server.providers["hotel"].holds
+        with band.lock:
+            del band.holds[slot_id]
+    return percentiles(samples, "rollback")
+
+
+def bench_upgrade_detect(booking, server, rounds: int) -> dict:
+    samples = []
+    monitor = booking.upgrade_monitor
+    for n in range(rounds):
+        server.reset()
+        booking.cache.clear()
+        # Block the early slots, hold a late one and wait for the monitor
+        # to notice when an early slot is freed
+        for provider in server.providers.values():
+            with provider.lock:
+                for slot_id in range(1, 11):
+                    provider.holds[slot_id] = "someone-else"
+        booking.run(booking.reserve_all(20, lambda *args: None))
+        booking.set_current_slot(20)
+        monitor.start(booking.loop, 20)
+        time.sleep(0.2)
+        start = time.perf_counter()
+        for provider in server.providers.values():
+            with provider.lock:
+                del provider.holds[5]
+        while monitor.current_slot != 5 and time.perf_counter() - start < 10:
+            time.sleep(0.002)
+        samples.append(time.perf_counter() - start)
+        monitor.stop()
+    server.reset()
+    return percentiles(samples, "upgrade_detect")
+
+
+def bench_matching(max_slots: int, providers: int = 3, repeat: int = 5,
+                   budget: float = 0.5) -> dict:
+    """CPU time to build each index from scratch, then apply a poll where
+    1% of one provider's slots changed. Each is run at least repeat times,
+    and until budget CPU seconds have been spent, keeping the fastest."""
+    results = {}
+    names = [f"provider{p}" for p in range(providers)]
+    n = 100
+    while n <= max_slots:
+        rng = random.Random(n)
+        snapshots = {name: {slot for slot in range(n) if rng.random() < 0.7}
+                     for name in names}
+        changed = set(rng.sample(range(n), max(1, n // 100)))
+        for kind, cls in (("sorted", MatchingIndex), ("bitmap", BitmapIndex)):
+            build, update = [], []
+            while len(build) < repeat or sum(build) + sum(update) < budget:
+                index = cls(names)
+                start = time.process_time()
+                for name in names:
+                    index.update_ids(name, snapshots[name])
+                build.append(time.process_time() - start)
+
+                start = time.process_time()
+                index.update_ids(names[0], snapshots[names[0]] ^ changed)
+                index.earliest()
+                index.top(5)
+                update.append(time.process_time() - start)
+            results[f"matching_{n}.{kind}_build_cpu"] = min(build)
+            results[f"matching_{n}.{kind}_update_cpu"] = min(update)
+        n *= 10
+    return results
+
+
+def run_benchmarks(args) -> dict:
+    server = SimulatedServer(slots=200, latency=args.latency, port=0,
+                             max_holds=1000, seed=1).start()
+    try:
+        booking = load_booking(server)
+        results = {}
+        results.update(bench_send_request(booking, args.requests))
+        results.update(bench_time_to_book(booking, server, args.rounds))
+        results.update(bench_rollback(booking, server, args.rounds))
+        results.update(bench_upgrade_detect(booking, server, max(3, args.rounds // 10)))
+        results.update(bench_matching(args.max_slots, repeat=args.repeat))
+        for _, api in booking.services:
+            booking.run(api.close())
+    finally:
+        server.stop()
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float,
+            floor: float = 0.0) -> list:
+    """Metrics that got worse than baseline by more than threshold. Rates
+    (.rps) should go up; everything else is a time and should go down,
+    and only counts if it grew by at least floor seconds."""
+    regressions = []
+    for name, value in results.items():
+        old = baseline.get(name)
+        if not old or value is None:
+            continue
+        if not name.endswith(".rps") and value - old < floor:
+            continue
+        change = (old - value) / old if name.endswith(".rps") else (value - old) / old
+        if change > threshold:
+            regressions.append((name, old, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the booking flows")
+    parser.add_argument("--out", default="bench.json", help="where to write results")
+    parser.add_argument("--compare", help="baseline results to check against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown that counts as a regression")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--latency", default="fixed:0.002",
+                        help="simulated server latency, see simserver.parse_latency")
+    parser.add_argument("--max-slots", type=int, default=10 ** 6)
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs of each CPU measurement, keeping the fastest")
+    parser.add_argument("--floor", type=float, default=0.001,
+                        help="seconds a time must grow by to count as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    with open(args.out, "w") as f:
+        json.dump({"python": platform.python_version(), "latency": args.latency,
+                   "results": results}, f, indent=2)
+    for name, value in results.items():
+        print(f"{name:36} {value:.6f}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold, args.floor)
+        for name, old, new, change in regressions:
+            print(f"REGRESSION {name}: {old:.6f} -> {new:.6f} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
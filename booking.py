@@ -1,6 +1,19 @@
 #!/usr/bin/python3
 import reservationapi
+import tracing
+from cache import ResponseCache
+from matching import BitmapIndex, MatchingIndex
+from monitor import UpgradeMonitor
+from reconciler import Reconciler
+from recorder import TrafficRecorder, ReplayTransport
+from metrics import Metrics
+from snapshot import SnapshotStore, HELD, AVAILABLE, age
+import argparse
+import atexit
 import configparser
+import sqlite3
+import threading
+import asyncio
 import time
 import os
 
@@ -27,75 +40,282 @@ def print_welcome_banner():
     """
     print(banner)
 
-api_cache = {}  
-CACHE_TTL = 2   
+config_path = os.environ.get("BOOKING_CONFIG", "api.ini")
+config = configparser.ConfigParser()
+config.read(config_path)
 
-def get_cached(key, func, *args, **kwargs):
-    now = time.time()
-    if key in api_cache:
-        result, ts = api_cache[key]
-        if now - ts < CACHE_TTL:
-            return result
-    result = func(*args, **kwargs)
-    api_cache[key] = (result, now)
-    return result
+def make_api(section, cls=reservationapi.AsyncReservationApi, **kwargs):
+    """Build an AsyncReservationApi (or ReservationApi) for a provider
+    section of api.ini"""
+    settings = config['global']
+    return cls(
+        config[section]['url'],
+        config[section]['key'],
+        int(settings['retries']),
+        float(settings['delay']),
+        pool_size=settings.getint('pool_size', fallback=4),
+        connect_timeout=settings.getfloat('connect_timeout', fallback=3.05),
+        read_timeout=settings.getfloat('read_timeout', fallback=10.0),
+        rate=settings.getfloat('rate', fallback=1.0),
+        headroom=settings.getfloat('rate_headroom', fallback=0.1),
+        backoff_max=settings.getfloat('backoff_max', fallback=8.0),
+        failure_threshold=settings.getint('failure_threshold', fallback=5),
+        reset_timeout=settings.getfloat('reset_timeout', fallback=30.0),
+        timeouts=reservationapi.endpoint_timeouts(settings),
+        deadline=settings.getfloat('deadline', fallback=0) or None,
+        hedge_percentile=settings.getfloat('hedge_percentile', fallback=0) or None,
+        recorder=recorder,
+        replay=replay,
+        metrics=metrics,
+        **kwargs
+    )
 
-config = configparser.ConfigParser()
-config.read("api.ini")
-
-hotel_api = reservationapi.ReservationApi(
-    config['hotel']['url'],
-    config['hotel']['key'],
-    int(config['global']['retries']),
-    float(config['global']['delay'])
-)
-
-band_api = reservationapi.ReservationApi(
-    config['band']['url'],
-    config['band']['key'],
-    int(config['global']['retries']),
-    float(config['global']['delay'])
-)
+# Every request can be recorded to, or answered from, a JSONL traffic log
+recorder = None
+if config['global'].get('record'):
+    recorder = TrafficRecorder(config['global']['record'])
+replay = None
+if config['global'].get('replay'):
+    replay = ReplayTransport(config['global']['replay'],
+                             speed=config['global'].getfloat('replay_speed', fallback=1.0))
+
+metrics = Metrics() if config['global'].getboolean('metrics', fallback=True) else None
+
+# One cache for every client, so a booking made through the async clients
+# also invalidates what the menu shows
+cache = ResponseCache(
+    maxsize=config['global'].getint('cache_size', fallback=128),
+    ttls={"/reservation/available": config['global'].getfloat('ttl_available', fallback=2.0),
+          "/reservation": config['global'].getfloat('ttl_held', fallback=2.0)},
+    metrics=metrics)
+
+# The last held and available slots seen are saved so the next launch can
+# show them before anything has been fetched
+snapshots = None
+if config['global'].get('snapshot'):
+    # Relative to api.ini, not to wherever the app was started from
+    snapshot_path = os.path.join(os.path.dirname(os.path.abspath(config_path)),
+                                 config['global']['snapshot'])
+    try:
+        snapshots = SnapshotStore(snapshot_path)
+    except sqlite3.Error as e:
+        print(f"{YELLOW}Snapshots disabled, cannot open {snapshot_path}: {e}{RESET}")
+
+def remember(name, kind, slots):
+    """Save freshly fetched held or available slots for the next launch"""
+    if snapshots is not None:
+        snapshots.save(config[name]['url'], config[name]['key'], kind, slots)
+
+# Every section with a url and key is a provider that must be booked for
+# the same slot (hotel, band, caterer, ...)
+providers = [section for section in config.sections()
+             if 'url' in config[section] and 'key' in config[section]]
+
+# Everything talks to every service at once through the async clients,
+# which live on an event loop in a background thread so the menu stays
+# blocking.
+services = tuple((name.capitalize(), make_api(name, cache=cache))
+                 for name in providers)
+
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, daemon=True).start()
+
+def run(coro):
+    """Run a coroutine on the background event loop and wait for its
+    result. Spans it starts nest under the caller's current span."""
+    return asyncio.run_coroutine_threadsafe(tracing.carry(coro), loop).result()
+
+# Slots free with every service, updated from each availability response
+if config['global'].get('matching', 'bitmap') == 'sorted':
+    matching_index = MatchingIndex(providers)
+else:
+    matching_index = BitmapIndex(providers)
+
+# Decode availability straight into arrays of slot IDs when matching
+compact = config['global'].getboolean('compact_availability', fallback=False)
+
+async def fetch_matching():
+    """Fetch every service's availability concurrently and return the
+    updated matching index"""
+    with tracing.span("fetch availability"):
+        if compact:
+            available = await asyncio.gather(
+                *(api.get_slot_ids_available() for _, api in services))
+        else:
+            available = await asyncio.gather(
+                *(api.get_slots_available() for _, api in services))
+    with tracing.span("update matching index"):
+        for name, slots in zip(providers, available):
+            matching_index.update(name, slots)
+    return matching_index
+
+async def release_on(slot_id, held, action, log=print):
+    """Release slot_id concurrently on every (name, api) pair in held. If
+    any release fails the reconciler is told, and run to reclaim what was
+    left."""
+    with reconciler.protect(slot_id), \
+            tracing.span("release", slot=slot_id, action=action) as phase:
+        results = await asyncio.gather(
+            *(api.release_slot(str(slot_id)) for _, api in held),
+            return_exceptions=True)
+        failed = sum(isinstance(result, Exception) for result in results)
+        phase.set(outcome=f"{failed} failed" if failed else "released")
+    for (name, _), result in zip(held, results):
+        if isinstance(result, Exception):
+            reconciler.owe(name, slot_id)
+            log(f"{RED}Error releasing {name.lower()} reservation for slot {slot_id}:{RESET} {result}")
+        else:
+            log(f"{YELLOW}{action} {name.lower()} reservation for slot {slot_id}.{RESET}")
+    if any(isinstance(result, Exception) for result in results):
+        reconciler.trigger()
+
+async def reserve_all(slot_id, log=print):
+    """Reserve slot_id on every service concurrently. If any fails the
+    others are released again, so the slot is either held everywhere or
+    nowhere. Returns True when every reservation succeeded."""
+    with reconciler.protect(slot_id), tracing.span("reserve", slot=slot_id) as phase:
+        results = await asyncio.gather(
+            *(api.reserve_slot(str(slot_id)) for _, api in services),
+            return_exceptions=True)
+        reserved = []
+        for (name, api), result in zip(services, results):
+            if isinstance(result, Exception):
+                log(f"{RED}{name} reservation failed for slot {slot_id}:{RESET} {result}")
+            else:
+                reserved.append((name, api))
+                log(f"{GREEN}{name} reservation succeeded for slot {slot_id}:{RESET} {result}")
+        if len(reserved) == len(services):
+            phase.set(outcome="held")
+            return True
+        phase.set(outcome="rolled back")
+        with tracing.span("rollback", slot=slot_id):
+            await release_on(slot_id, reserved, "Cancelled partial", log)
+        return False
+
+async def speculative_reserve(k):
+    """Reserve up to k of the earliest matching slots on every service at
+    once, keep the earliest slot held on all of them and release every other
+    hold. k is capped by the reservation limit left on each service and by
+    how many requests the rate limit lets through in speculative_window
+    seconds. Returns (slot or None, holds made, holds released)."""
+    max_holds = config['global'].getint('max_holds', fallback=2)
+    window = config['global'].getfloat('speculative_window', fallback=2.0)
+    held = await asyncio.gather(*(api.get_slots_held() for _, api in services))
+    k = min([k, max_holds - max(len(slots) for slots in held)]
+            + [max(1, int(api.limiter.rate * window)) for _, api in services])
+    if k <= 0:
+        print(f"{RED}Reservation limit reached ({max_holds} slots); release a slot first.{RESET}")
+        return None, 0, 0
+
+    candidates = (await fetch_matching()).top(k)
+    print(f"{CYAN}Speculatively reserving slots {candidates} on all services...{RESET}")
+    with reconciler.protect(*candidates), \
+            tracing.span("speculative reserve", slots=candidates) as phase:
+        results = await asyncio.gather(
+            *(api.reserve_slot(str(slot_id)) for slot_id in candidates for _, api in services),
+            return_exceptions=True)
+
+        holds = {slot_id: [] for slot_id in candidates}
+        for i, result in enumerate(results):
+            slot_id = candidates[i // len(services)]
+            name, api = services[i % len(services)]
+            if isinstance(result, Exception):
+                print(f"{RED}{name} reservation failed for slot {slot_id}:{RESET} {result}")
+            else:
+                holds[slot_id].append((name, api))
+
+        winner = next((slot_id for slot_id in candidates
+                       if len(holds[slot_id]) == len(services)), None)
+        phase.set(slot=winner, outcome="held" if winner is not None else "no slot held")
+        losers = {}
+        for slot_id, held in holds.items():
+            if slot_id != winner:
+                for name, api in held:
+                    losers.setdefault(name, (api, []))[1].append(str(slot_id))
+        made = sum(len(held) for held in holds.values())
+        with tracing.span("release losers"):
+            released = await asyncio.gather(
+                *(api.release_many(slot_ids) for api, slot_ids in losers.values()))
+    failed = 0
+    for name, results in zip(losers, released):
+        for slot_id, result in results.items():
+            if isinstance(result, Exception):
+                failed += 1
+                reconciler.owe(name, slot_id)
+                print(f"{RED}Error releasing speculative {name.lower()} hold on slot {slot_id}:{RESET} {result}")
+    if failed:
+        reconciler.trigger()
+    return winner, made, sum(len(results) for results in released) - failed
 
 current_slot = None
 
+# Releases holds that this process failed to release (orphans of failed
+# rollbacks), keeping the current booking
+reconciler = Reconciler(services, lambda: [current_slot],
+                        interval=config['global'].getfloat('reconcile_interval', fallback=60.0))
+
+async def fetch_all(call):
+    """Call call(api) on every service concurrently, returning each
+    result or the exception it raised"""
+    return await asyncio.gather(*(call(api) for _, api in services),
+                                return_exceptions=True)
+
 def view_current_reservations():
-    try:
-        hotel_held = get_cached("hotel_held", hotel_api.get_slots_held)
-    except Exception as e:
-        hotel_held = f"{RED}Error: {e}{RESET}"
-    try:
-        band_held = get_cached("band_held", band_api.get_slots_held)
-    except Exception as e:
-        band_held = f"{RED}Error: {e}{RESET}"
     print(f"\n{BOLD}{YELLOW}Current Reservations:{RESET}")
-    print(f"{GREEN}Hotel held slots:{RESET} {hotel_held}")
-    print(f"{GREEN}Band held slots:{RESET} {band_held}")
+    for name, held in zip(providers, run(fetch_all(lambda api: api.get_slots_held()))):
+        if isinstance(held, Exception):
+            held = f"{RED}Error: {held}{RESET}"
+        else:
+            remember(name, HELD, held)
+        print(f"{GREEN}{name.capitalize()} held slots:{RESET} {held}")
+
+def view_snapshot():
+    """Show the held and available slots saved by the last run, marked
+    with their age. Returns False if nothing has been saved yet."""
+    saved = {name: (snapshots.load(config[name]['url'], config[name]['key'], HELD),
+                    snapshots.load(config[name]['url'], config[name]['key'], AVAILABLE))
+             for name in providers} if snapshots is not None else {}
+    if not any(held or available for held, available in saved.values()):
+        return False
+    print(f"\n{BOLD}{YELLOW}Last Known Reservations{RESET} {MAGENTA}(saved, refreshing in the background){RESET}")
+    for name, (held, available) in saved.items():
+        if held is not None:
+            print(f"{GREEN}{name.capitalize()} held slots:{RESET} {held[1]} {YELLOW}[stale, {age(held[0])} old]{RESET}")
+        if available is not None:
+            print(f"{GREEN}{name.capitalize()} available (first 20):{RESET} {available[1][:20]} "
+                  f"{YELLOW}[stale, {age(available[0])} old]{RESET}")
+    return True
+
+async def refresh_snapshot():
+    """Fetch held and available slots from every service and save them"""
+    held, available = await asyncio.gather(
+        fetch_all(lambda api: api.get_slots_held()),
+        fetch_all(lambda api: api.get_slots_available()))
+    for name, slots in zip(providers, held):
+        if not isinstance(slots, Exception):
+            remember(name, HELD, slots)
+    for name, slots in zip(providers, available):
+        if not isinstance(slots, Exception):
+            remember(name, AVAILABLE, slots)
 
 def view_available_slots():
-    try:
-        hotel_avail = get_cached("hotel_avail", hotel_api.get_slots_available)
-    except Exception as e:
-        hotel_avail = []
-        print(f"{RED}Error fetching hotel available slots: {e}{RESET}")
-    try:
-        band_avail = get_cached("band_avail", band_api.get_slots_available)
-    except Exception as e:
-        band_avail = []
-        print(f"{RED}Error fetching band available slots: {e}{RESET}")
+    available = {}
+    for name, slots in zip(providers, run(fetch_all(lambda api: api.get_slots_available()))):
+        if isinstance(slots, Exception):
+            available[name] = []
+            print(f"{RED}Error fetching {name} available slots: {slots}{RESET}")
+        else:
+            available[name] = slots
+            remember(name, AVAILABLE, slots)
     print(f"\n{BOLD}{YELLOW}Available Slots (first 20):{RESET}")
-    print(f"{GREEN}Hotel:{RESET} {hotel_avail[:20]}")
-    print(f"{GREEN}Band:{RESET} {band_avail[:20]}")
+    for name, slots in available.items():
+        print(f"{GREEN}{name.capitalize()}:{RESET} {slots[:20]}")
 
 def view_matching_slots():
     try:
-        hotel_avail = get_cached("hotel_avail", hotel_api.get_slots_available)
-        band_avail = get_cached("band_avail", band_api.get_slots_available)
-        hotel_ids = set(int(slot["id"]) for slot in hotel_avail)
-        band_ids = set(int(slot["id"]) for slot in band_avail)
-        matching = sorted(hotel_ids.intersection(band_ids))
-        if matching:
-            print(f"\n{BOLD}{YELLOW}Matching Slots (first 5):{RESET} {matching[:5]}")
+        index = run(fetch_matching())
+        if index:
+            print(f"\n{BOLD}{YELLOW}Matching Slots (first 5):{RESET} {index.top(5)}")
         else:
             print(f"\n{RED}No matching slots available.{RESET}")
     except Exception as e:
@@ -103,105 +323,38 @@ def view_matching_slots():
 
 def manually_reserve_slot():
     slot_id = input(f"\n{BOLD}Enter slot ID to reserve: {RESET}").strip()
-    hotel_reserved = False
-    band_reserved = False
-    try:
-        hotel_resp = hotel_api.reserve_slot(slot_id)
-        hotel_reserved = True
-        print(f"{GREEN}Hotel reservation succeeded for slot {slot_id}:{RESET} {hotel_resp}")
-    except Exception as e:
-        print(f"{RED}Hotel reservation failed for slot {slot_id}:{RESET} {e}")
-
-    time.sleep(1) 
-
-    try:
-        band_resp = band_api.reserve_slot(slot_id)
-        band_reserved = True
-        print(f"{GREEN}Band reservation succeeded for slot {slot_id}:{RESET} {band_resp}")
-    except Exception as e:
-        print(f"{RED}Band reservation failed for slot {slot_id}:{RESET} {e}")
-
-    if hotel_reserved and band_reserved:
-        print(f"{BOLD}{GREEN}Successfully reserved slot {slot_id} for both services.{RESET}")
+    with tracing.span("manual reservation", slot=slot_id) as phase:
+        reserved = run(reserve_all(slot_id))
+        phase.set(outcome="reserved" if reserved else "aborted")
+    if reserved:
+        print(f"{BOLD}{GREEN}Successfully reserved slot {slot_id} for all services.{RESET}")
         return int(slot_id)
-    else:
-        if hotel_reserved:
-            try:
-                hotel_api.release_slot(slot_id)
-                print(f"{YELLOW}Cancelled hotel reservation for slot {slot_id} due to incomplete booking.{RESET}")
-            except Exception as e:
-                print(f"{RED}Error cancelling hotel reservation for slot {slot_id}:{RESET} {e}")
-        if band_reserved:
-            try:
-                band_api.release_slot(slot_id)
-                print(f"{YELLOW}Cancelled band reservation for slot {slot_id} due to incomplete booking.{RESET}")
-            except Exception as e:
-                print(f"{RED}Error cancelling band reservation for slot {slot_id}:{RESET} {e}")
-        print(f"{RED}Manual reservation aborted due to incomplete booking.{RESET}")
-        return None
+    print(f"{RED}Manual reservation aborted due to incomplete booking.{RESET}")
+    return None
 
 def cancel_reservation():
     """Cancels a reservation for a given slot by prompting the user for a slot ID."""
     slot_id = input(f"\n{BOLD}Enter slot ID to cancel: {RESET}").strip()
-    try:
-        hotel_resp = hotel_api.release_slot(slot_id)
-        print(f"{GREEN}Hotel reservation for slot {slot_id} cancelled:{RESET} {hotel_resp}")
-    except Exception as e:
-        print(f"{RED}Error cancelling hotel reservation for slot {slot_id}:{RESET} {e}")
-
-    try:
-        band_resp = band_api.release_slot(slot_id)
-        print(f"{GREEN}Band reservation for slot {slot_id} cancelled:{RESET} {band_resp}")
-    except Exception as e:
-        print(f"{RED}Error cancelling band reservation for slot {slot_id}:{RESET} {e}")
+    run(release_on(slot_id, services, "Cancelled"))
 
 def auto_reserve_earliest_matching_slot():
     
     try:
-        hotel_avail = get_cached("hotel_avail", hotel_api.get_slots_available)
-        band_avail = get_cached("band_avail", band_api.get_slots_available)
-        hotel_ids = set(int(slot["id"]) for slot in hotel_avail)
-        band_ids = set(int(slot["id"]) for slot in band_avail)
-        matching = sorted(hotel_ids.intersection(band_ids))
-        if not matching:
-            print(f"\n{RED}No matching slots available for auto-reservation.{RESET}")
-            return None
-        earliest = matching[0]
-        print(f"\n{BOLD}Attempting to reserve the earliest matching slot: {earliest}{RESET}")
-        hotel_reserved = False
-        band_reserved = False
-        try:
-            hotel_resp = hotel_api.reserve_slot(str(earliest))
-            hotel_reserved = True
-            print(f"{GREEN}Hotel reservation succeeded for slot {earliest}:{RESET} {hotel_resp}")
-        except Exception as e:
-            print(f"{RED}Hotel reservation failed for slot {earliest}:{RESET} {e}")
-
-        time.sleep(1)
-
-        try:
-            band_resp = band_api.reserve_slot(str(earliest))
-            band_reserved = True
-            print(f"{GREEN}Band reservation succeeded for slot {earliest}:{RESET} {band_resp}")
-        except Exception as e:
-            print(f"{RED}Band reservation failed for slot {earliest}:{RESET} {e}")
-
-        if hotel_reserved and band_reserved:
-            print(f"{BOLD}{GREEN}Successfully reserved earliest matching slot {earliest} for both services.{RESET}")
-            return earliest
-        else:
-            if hotel_reserved:
-                try:
-                    hotel_api.release_slot(str(earliest))
-                    print(f"{YELLOW}Cancelled hotel reservation for slot {earliest} due to partial booking.{RESET}")
-                except Exception as e:
-                    print(f"{RED}Error cancelling hotel reservation for slot {earliest}:{RESET} {e}")
-            if band_reserved:
-                try:
-                    band_api.release_slot(str(earliest))
-                    print(f"{YELLOW}Cancelled band reservation for slot {earliest} due to partial booking.{RESET}")
-                except Exception as e:
-                    print(f"{RED}Error cancelling band reservation for slot {earliest}:{RESET} {e}")
+        with tracing.span("auto reservation") as phase:
+            index = run(fetch_matching())
+            with tracing.span("match"):
+                earliest = index.earliest()
+            phase.set(slot=earliest)
+            if earliest is None:
+                phase.set(outcome="no matching slot")
+                print(f"\n{RED}No matching slots available for auto-reservation.{RESET}")
+                return None
+            print(f"\n{BOLD}Attempting to reserve the earliest matching slot: {earliest}{RESET}")
+            if run(reserve_all(earliest)):
+                phase.set(outcome="reserved")
+                print(f"{BOLD}{GREEN}Successfully reserved earliest matching slot {earliest} for all services.{RESET}")
+                return earliest
+            phase.set(outcome="aborted")
             print(f"{RED}Auto-reservation aborted due to incomplete booking.{RESET}")
             return None
 
@@ -209,75 +362,111 @@ def auto_reserve_earliest_matching_slot():
         print(f"{RED}Error during auto-reservation: {e}{RESET}")
         return None
 
-def continuous_upgrade_monitoring(current_slot, upgrade_interval=30):
-    
-    print(f"\n{BOLD}{CYAN}Starting continuous upgrade monitoring...{RESET}")
-    print(f"{MAGENTA}Press Ctrl-C to stop monitoring and return to the main menu.{RESET}")
-    while True:
-        try:
-            hotel_avail = get_cached("hotel_avail", hotel_api.get_slots_available)
-            band_avail = get_cached("band_avail", band_api.get_slots_available)
-            hotel_ids = set(int(slot["id"]) for slot in hotel_avail)
-            band_ids = set(int(slot["id"]) for slot in band_avail)
-            matching = sorted(hotel_ids.intersection(band_ids))
-            
-            if not matching:
-                print(f"{YELLOW}No matching slots available for upgrade at this time.{RESET}")
-            else:
-                best_available = matching[0]
-                if best_available < current_slot:
-                    print(f"\n{BOLD}{CYAN}Better slot found: {best_available} (current reserved: {current_slot}){RESET}")
-                    new_hotel_reserved = False
-                    new_band_reserved = False
-                    try:
-                        hotel_resp = hotel_api.reserve_slot(str(best_available))
-                        new_hotel_reserved = True
-                        print(f"{GREEN}Hotel upgrade reservation succeeded for slot {best_available}:{RESET} {hotel_resp}")
-                    except Exception as e:
-                        print(f"{RED}Hotel upgrade reservation failed for slot {best_available}:{RESET} {e}")
-                    
-                    time.sleep(1)
-                    
-                    try:
-                        band_resp = band_api.reserve_slot(str(best_available))
-                        new_band_reserved = True
-                        print(f"{GREEN}Band upgrade reservation succeeded for slot {best_available}:{RESET} {band_resp}")
-                    except Exception as e:
-                        print(f"{RED}Band upgrade reservation failed for slot {best_available}:{RESET} {e}")
-
-                    if new_hotel_reserved and new_band_reserved:
-                        print(f"{BOLD}{GREEN}Upgrade successful: new slot {best_available} reserved on both services.{RESET}")
-                        try:
-                            hotel_api.release_slot(str(current_slot))
-                            print(f"{YELLOW}Released hotel reservation for old slot {current_slot}.{RESET}")
-                        except Exception as e:
-                            print(f"{RED}Error releasing hotel old slot {current_slot}:{RESET} {e}")
-                        try:
-                            band_api.release_slot(str(current_slot))
-                            print(f"{YELLOW}Released band reservation for old slot {current_slot}.{RESET}")
-                        except Exception as e:
-                            print(f"{RED}Error releasing band old slot {current_slot}:{RESET} {e}")
-                        current_slot = best_available
-                    else:
-                        if new_hotel_reserved:
-                            try:
-                                hotel_api.release_slot(str(best_available))
-                                print(f"{YELLOW}Cancelled partial hotel upgrade for slot {best_available}.{RESET}")
-                            except Exception as e:
-                                print(f"{RED}Error cancelling hotel upgrade for slot {best_available}:{RESET} {e}")
-                        if new_band_reserved:
-                            try:
-                                band_api.release_slot(str(best_available))
-                                print(f"{YELLOW}Cancelled partial band upgrade for slot {best_available}.{RESET}")
-                            except Exception as e:
-                                print(f"{RED}Error cancelling band upgrade for slot {best_available}:{RESET} {e}")
-                        print(f"{RED}Upgrade attempt aborted due to partial booking failure.{RESET}")
-                else:
-                    print(f"{CYAN}No upgrade available. Current slot {current_slot} remains optimal (best available: {matching[0]}).{RESET}")
-        except Exception as e:
-            print(f"{RED}Error during upgrade monitoring: {e}{RESET}")
-        
-        time.sleep(upgrade_interval) 
+def speculatively_reserve_matching_slot():
+    k = config['global'].getint('speculative_k', fallback=3)
+    try:
+        winner, made, released = run(speculative_reserve(k))
+    except Exception as e:
+        print(f"{RED}Error during speculative reservation: {e}{RESET}")
+        return None
+    print(f"{CYAN}Speculative holds made: {made}, released: {released}.{RESET}")
+    if winner is None:
+        print(f"{RED}Speculative reservation failed: no slot could be held on all services.{RESET}")
+        return None
+    print(f"{BOLD}{GREEN}Successfully reserved slot {winner} for all services.{RESET}")
+    return winner
+
+async def upgrade_slot(old_slot, new_slot, log=print):
+    """Move the booking from old_slot to new_slot on every service,
+    releasing old_slot only once new_slot is held everywhere"""
+    with tracing.span("upgrade", slot=new_slot, old_slot=old_slot) as phase:
+        if not await reserve_all(new_slot, log):
+            phase.set(outcome="aborted")
+            log(f"{RED}Upgrade attempt aborted due to partial booking failure.{RESET}")
+            return False
+        log(f"{BOLD}{GREEN}Upgrade successful: new slot {new_slot} reserved on all services.{RESET}")
+        await release_on(old_slot, services, "Released old", log)
+        phase.set(outcome="upgraded")
+        return True
+
+def set_current_slot(slot_id):
+    """Record the slot now booked on every service, which the upgrade
+    monitor (if running) then tries to improve on"""
+    global current_slot
+    current_slot = slot_id
+    upgrade_monitor.current_slot = slot_id
+
+upgrade_monitor = UpgradeMonitor(
+    fetch_matching, upgrade_slot,
+    min_interval=config['global'].getfloat('upgrade_min_interval', fallback=2.0),
+    max_interval=config['global'].getfloat('upgrade_max_interval', fallback=30.0),
+    on_upgrade=set_current_slot)
+
+def continuous_upgrade_monitoring(current_slot):
+    """Start watching for an earlier matching slot in the background"""
+    upgrade_monitor.start(loop, current_slot)
+    print(f"\n{BOLD}{CYAN}Continuous upgrade monitoring started in the background for slot {current_slot}.{RESET}")
+    print(f"{MAGENTA}Use the menu to check its status or stop it.{RESET}")
+
+def view_upgrade_monitor():
+    status = upgrade_monitor.status()
+    state = f"{GREEN}running{RESET}" if status["running"] else f"{YELLOW}stopped{RESET}"
+    print(f"\n{BOLD}{YELLOW}Upgrade Monitor:{RESET} {state}")
+    print(f"{GREEN}Current slot:{RESET} {status['current_slot']}")
+    print(f"{GREEN}Polls:{RESET} {status['polls']}  {GREEN}Upgrades:{RESET} {status['upgrades']}  "
+          f"{GREEN}Next poll in:{RESET} {status['interval']:.0f}s")
+    for event in status["events"]:
+        print(f"  {event}")
+
+def reconcile_held_slots():
+    try:
+        reclaimed = run(reconciler.reconcile())
+    except Exception as e:
+        print(f"{RED}Error during reconciliation: {e}{RESET}")
+        return
+    if reclaimed:
+        for name, slot_id in reclaimed:
+            print(f"{YELLOW}Reclaimed orphaned {name.lower()} hold on slot {slot_id}.{RESET}")
+    else:
+        print(f"\n{GREEN}No orphaned holds found.{RESET}")
+    status = reconciler.status()
+    state = f"{GREEN}running every {status['interval']:.0f}s{RESET}" if status["running"] else f"{YELLOW}stopped{RESET}"
+    print(f"\n{BOLD}{YELLOW}Reconciler:{RESET} {state}  {GREEN}Passes:{RESET} {status['passes']}  "
+          f"{GREEN}Holds reclaimed:{RESET} {status['reclaimed']}  "
+          f"{GREEN}Still to release:{RESET} {status['owed']}")
+    for event in status["events"]:
+        print(f"  {event}")
+
+def print_metrics():
+    """Print a summary of the metrics collected so far"""
+    print(f"{BOLD}{YELLOW}Request Metrics:{RESET}")
+    for host, entry in metrics.snapshot().items():
+        print(f"\n{BOLD}{CYAN}{host}{RESET}")
+        for endpoint, data in sorted(entry["endpoints"].items()):
+            latency = data["latency"]
+            mean = latency["sum"] / latency["count"] * 1000 if latency["count"] else 0.0
+            outcomes = ", ".join(f"{outcome}: {count}" for outcome, count in sorted(data["requests"].items()))
+            print(f"  {GREEN}{endpoint}{RESET}")
+            cache_info = ""
+            if data["cache"]["hits"] + data["cache"]["misses"]:
+                cache_info = f", cache hit ratio {data['cache']['hit_ratio']:.0%}"
+            print(f"    requests {latency['count']} ({outcomes or 'none'}), mean {mean:.1f} ms, "
+                  f"retries {data['retries']}, hedges {data['hedges']}{cache_info}")
+        waits = ", ".join(f"{kind} {seconds:.2f}s" for kind, seconds in sorted(entry["waits"].items()))
+        print(f"  {GREEN}waited:{RESET} {waits or 'none'}")
+
+def view_metrics_live():
+    if metrics is None:
+        print(f"{RED}Metrics are disabled (set metrics = true in api.ini).{RESET}")
+        return
+    try:
+        while True:
+            clear_screen()
+            print_metrics()
+            print(f"\n{MAGENTA}Refreshing every second. Press Ctrl-C to return to the menu.{RESET}")
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print()
 
 def print_menu():
     menu = f"""
@@ -288,8 +477,12 @@ def print_menu():
 {BOLD}4.{RESET} Manually Reserve a Specific Slot
 {BOLD}5.{RESET} Cancel a Reservation
 {BOLD}6.{RESET} Automatically Reserve the Earliest Matching Slot
-{BOLD}7.{RESET} Start Continuous Upgrade Monitoring
-{BOLD}8.{RESET} Exit
+{BOLD}7.{RESET} Start/Stop Background Upgrade Monitoring
+{BOLD}8.{RESET} Speculatively Reserve One of the Earliest Matching Slots
+{BOLD}9.{RESET} View Upgrade Monitor Status
+{BOLD}10.{RESET} View Live Metrics
+{BOLD}11.{RESET} Reconcile Held Slots
+{BOLD}12.{RESET} Exit
 {BOLD}{BLUE}================================{RESET}
 """
     print(menu)
@@ -300,7 +493,7 @@ def main_menu():
         clear_screen()
         print_welcome_banner()
         print_menu()
-        choice = input(f"{BOLD}Select an option (1-8): {RESET}").strip()
+        choice = input(f"{BOLD}Select an option (1-12): {RESET}").strip()
         if choice == "1":
             view_current_reservations()
         elif choice == "2":
@@ -310,32 +503,65 @@ def main_menu():
         elif choice == "4":
             reserved = manually_reserve_slot()
             if reserved is not None:
-                current_slot = reserved
+                set_current_slot(reserved)
         elif choice == "5":
             cancel_reservation()
         elif choice == "6":
             reserved = auto_reserve_earliest_matching_slot()
             if reserved is not None:
-                current_slot = reserved
+                set_current_slot(reserved)
         elif choice == "7":
-            if current_slot is None:
-                print(f"{RED}No current reservation available. Please reserve a slot first (option 4 or 6).{RESET}")
+            if upgrade_monitor.running:
+                upgrade_monitor.stop()
+                print(f"\n{YELLOW}Continuous upgrade monitoring stopped.{RESET}")
+            elif current_slot is None:
+                print(f"{RED}No current reservation available. Please reserve a slot first (option 4, 6 or 8).{RESET}")
             else:
-                try:
-                    continuous_upgrade_monitoring(current_slot)
-                except KeyboardInterrupt:
-                    print(f"\n{YELLOW}Continuous upgrade monitoring stopped. Returning to main menu.{RESET}")
+                continuous_upgrade_monitoring(current_slot)
         elif choice == "8":
+            reserved = speculatively_reserve_matching_slot()
+            if reserved is not None:
+                set_current_slot(reserved)
+        elif choice == "9":
+            view_upgrade_monitor()
+        elif choice == "10":
+            view_metrics_live()
+        elif choice == "11":
+            reconcile_held_slots()
+        elif choice == "12":
+            upgrade_monitor.stop()
+            reconciler.stop()
             print(f"{MAGENTA}Exiting. Goodbye!{RESET}")
+            for _, api in services:
+                run(api.close())
+            if recorder is not None:
+                recorder.close()
+            if snapshots is not None:
+                snapshots.close()
             break
         else:
-            print(f"{RED}Invalid choice, please select a number between 1 and 8.{RESET}")
-        time.sleep(1)
+            print(f"{RED}Invalid choice, please select a number between 1 and 12.{RESET}")
+        with tracing.span("menu pause"):
+            time.sleep(1)
         input(f"\n{BOLD}Press Enter to continue...{RESET}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Book a slot with every service")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Record phase timings and save them as a Chrome trace on exit")
+    args = parser.parse_args()
+    if args.trace:
+        tracing.enable()
+        atexit.register(tracing.write, args.trace)
     clear_screen()
     print_welcome_banner()
-    view_current_reservations()  
+    # Show what was saved last time straight away and fetch the current
+    # state in the background
+    if reconciler.interval > 0:
+        reconciler.start(loop)
+    if view_snapshot():
+        asyncio.run_coroutine_threadsafe(refresh_snapshot(), loop)
+    else:
+        view_current_reservations()
     input(f"\n{BOLD}Press Enter to proceed to the menu...{RESET}")
     main_menu()
@@ -0,0 +1,92 @@
+""" Per-host circuit breaker
+
+This module implements a circuit breaker shared by every client of the
+same base URL. After repeated server errors or connection failures the
+circuit opens and requests fail fast with CircuitOpenError instead of
+spending their retry budget against a host that is known to be down.
+Once the reset timeout has passed a single probe request is let through;
+its outcome closes the circuit again or re-opens it.
+
+A 503 carrying Retry-After is the server throttling one API token, not the
+host failing, so clients do not report it here: one busy token must not
+make every other token of the host fail fast.
+"""
+
+import threading
+import time
+
+from exceptions import CircuitOpenError
+
+CLOSED    = "closed"
+OPEN      = "open"
+HALF_OPEN = "half-open"
+
+# Breakers shared between clients, keyed by normalised base URL
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5,
+                 reset_timeout: float = 30.0):
+        """ Create a circuit breaker.
+
+        Args:
+            name: The base URL the breaker protects, used in error messages.
+            failure_threshold: Consecutive failures that open the circuit.
+            reset_timeout: Seconds to fail fast before letting a probe
+                request through.
+        """
+        self.name              = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout     = reset_timeout
+        self.failures          = 0
+        self._state            = CLOSED
+        self._opened_at        = 0.0
+        self._lock             = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def before_request(self):
+        """Raise CircuitOpenError unless a request may be sent now"""
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(
+                    f"{self.name} is failing, not retrying for {remaining:.1f}s")
+            # Let this request through as the probe. Everyone else keeps
+            # failing fast until it reports back (or itself times out).
+            self._state = HALF_OPEN
+            self._opened_at = time.monotonic()
+
+    def record_success(self):
+        """The server answered without a server-side error"""
+        with self._lock:
+            self._state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        """The server returned a 5xx error or could not be reached"""
+        with self._lock:
+            self.failures += 1
+            if (self._state == HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+
+def breaker_for(base_url: str, failure_threshold: int = 5,
+                reset_timeout: float = 30.0) -> CircuitBreaker:
+    """Return the breaker shared by every client of base_url, creating it
+    on first use."""
+    key = base_url.rstrip("/")
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(
+                key, failure_threshold, reset_timeout)
+        return breaker
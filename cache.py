@@ -0,0 +1,207 @@
+""" Response cache for reservation API reads
+
+This module implements the cache used by ReservationApi and
+AsyncReservationApi for GET requests. Entries expire after a per-endpoint
+TTL, the cache is bounded with least-recently-used eviction, and any
+write to a service invalidates everything cached for it. Concurrent
+misses on the same key are coalesced so that only one request is in
+flight at a time; the other callers share its result (or its exception).
+If the load is interrupted instead (cancelled, or a KeyboardInterrupt),
+the waiting callers are not: they retry the load themselves.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Flight:
+    """A load in progress that other callers can wait on"""
+
+    def __init__(self):
+        self.done      = threading.Event()
+        self.future    = None
+        self.value     = None
+        self.error     = None
+        self.abandoned = False
+
+    async def wait_async(self):
+        """Wait for the load without blocking the event loop"""
+        if self.future is not None and self.future.get_loop() is asyncio.get_running_loop():
+            await asyncio.shield(self.future)
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, self.done.wait)
+
+
+class ResponseCache:
+    def __init__(self, maxsize: int = 128, ttls: dict = None,
+                 default_ttl: float = 2.0, metrics=None):
+        """ Create a response cache.
+
+        Args:
+            maxsize: The number of responses to keep before evicting the
+                least recently used.
+            ttls: Seconds to keep responses for, by endpoint. A TTL of 0
+                disables caching for the endpoint but still coalesces
+                concurrent requests.
+            default_ttl: The TTL of endpoints missing from ttls.
+            metrics: A Metrics to report hits and misses to, per service
+                and endpoint.
+        """
+        self.maxsize     = maxsize
+        self.ttls        = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.hits        = 0
+        self.misses      = 0
+        self.coalesced   = 0
+        self.evictions   = 0
+        self.metrics     = metrics
+        self._entries     = OrderedDict()
+        self._flights     = {}
+        self._generations = {}
+        self._lock        = threading.Lock()
+
+    def _lookup(self, key):
+        """Return (True, value) for a fresh entry, else (False, flight)
+        where flight is the load to wait on, or None if the caller should
+        load the value itself. Must be called with the lock held."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if self.metrics is not None:
+                    self.metrics.cache(key[0], key[2], True)
+                return True, value
+            del self._entries[key]
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        if self.metrics is not None:
+            # A coalesced lookup sends no request of its own
+            self.metrics.cache(key[0], key[2], flight is not None)
+        return False, flight
+
+    def _start(self, key):
+        """Register a new load for key. Must be called with the lock held."""
+        flight = self._flights[key] = _Flight()
+        return flight, self._generations.get(key[0], 0)
+
+    def _finish(self, key, flight, generation, value=None, error=None,
+                abandoned=False):
+        """Store the result of a load and wake anyone waiting on it. An
+        abandoned load has no result; its waiters load the value again."""
+        with self._lock:
+            del self._flights[key]
+            # Only store the value if nothing was written to the service
+            # while it was being fetched, otherwise it may already be stale
+            ttl = self.ttls.get(key[2], self.default_ttl)
+            if (error is None and not abandoned and ttl > 0
+                    and self._generations.get(key[0], 0) == generation):
+                self._entries[key] = (time.monotonic() + ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        flight.value     = value
+        flight.error     = error
+        flight.abandoned = abandoned
+        flight.done.set()
+        if flight.future is not None and not flight.future.done():
+            flight.future.set_result(None)
+
+    def get_or_load(self, base_url: str, token: str, endpoint: str, loader,
+                    variant: str = ""):
+        """Return the cached response for endpoint, calling loader() to
+        fetch it if needed. variant tells apart differently decoded
+        copies of the same response."""
+        key = (base_url.rstrip("/"), token, endpoint, variant)
+        while True:
+            with self._lock:
+                found, result = self._lookup(key)
+                if found:
+                    return result
+                if result is None:
+                    flight, generation = self._start(key)
+                    break
+            result.done.wait()
+            if result.abandoned:
+                continue
+            if result.error is not None:
+                raise result.error
+            return result.value
+
+        try:
+            value = loader()
+        except Exception as e:
+            self._finish(key, flight, generation, error=e)
+            raise
+        except BaseException:
+            self._finish(key, flight, generation, abandoned=True)
+            raise
+        self._finish(key, flight, generation, value)
+        return value
+
+    async def get_or_load_async(self, base_url: str, token: str,
+                                endpoint: str, loader, variant: str = ""):
+        """Coroutine version of get_or_load, where loader() returns an
+        awaitable."""
+        key = (base_url.rstrip("/"), token, endpoint, variant)
+        while True:
+            with self._lock:
+                found, result = self._lookup(key)
+                if found:
+                    return result
+                if result is None:
+                    flight, generation = self._start(key)
+                    flight.future = asyncio.get_running_loop().create_future()
+                    break
+            await result.wait_async()
+            if result.abandoned:
+                continue
+            if result.error is not None:
+                raise result.error
+            return result.value
+
+        try:
+            value = await loader()
+        except Exception as e:
+            self._finish(key, flight, generation, error=e)
+            raise
+        except BaseException:
+            # Cancelled or interrupted: that is the loader's caller's
+            # business, not the waiters', who load the value again
+            self._finish(key, flight, generation, abandoned=True)
+            raise
+        self._finish(key, flight, generation, value)
+        return value
+
+    def invalidate(self, base_url: str):
+        """Forget everything cached for a service, including loads that
+        are still in flight"""
+        base_url = base_url.rstrip("/")
+        with self._lock:
+            self._generations[base_url] = self._generations.get(base_url, 0) + 1
+            for key in [key for key in self._entries if key[0] == base_url]:
+                del self._entries[key]
+
+    def clear(self):
+        """Forget everything cached for every service"""
+        with self._lock:
+            for base_url in {key[0] for key in [*self._entries, *self._flights]}:
+                self._generations[base_url] = self._generations.get(base_url, 0) + 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Report hit/miss counters and the current size"""
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {"hits": self.hits, "misses": self.misses,
+                    "coalesced": self.coalesced, "evictions": self.evictions,
+                    "size": len(self._entries),
+                    "hit_ratio": (self.hits + self.coalesced) / lookups
+                                 if lookups else 0.0}
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+""" Booking daemon
+
+Keeps one set of clients running so that any number of local tools can
+share their warm connection pools, cache and rate-limit budget instead of
+each starting cold. Operations are served as JSON over HTTP, on a local
+TCP port or a Unix socket:
+
+    GET  /held                        slots held with each service
+    GET  /available?limit=20          slots available with each service
+    GET  /matching?limit=5&after=10   slots available with every service
+    POST /reserve   {"slot": 12}      reserve a slot, or the earliest
+                                      matching one if no slot is given
+    POST /cancel    {"slot": 12}      release a slot, or every held slot
+    POST /upgrade   {"slot": 12}      move to the earliest matching slot
+                                      before the given one
+    GET  /status                      queue depth and cache statistics
+    GET  /metrics                     request metrics, Prometheus format
+
+Reads run straight away, and identical concurrent reads are coalesced into
+one upstream request by the shared cache. Writes are queued and run one at
+a time, cancellations first, then reservations, then upgrades. Requests use
+the keys in the config file; a POST body (or token.<provider> query
+parameters) may give other tokens, as in batch jobs, along with
+"constraints" for choosing a matching slot.
+
+    python3 daemon.py --port 8100
+    python3 daemon.py --socket /tmp/booking.sock
+"""
+
+import argparse
+import asyncio
+import configparser
+import itertools
+import json
+import os
+import signal
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from batch import BatchRunner, JobError, job_constraints, number_field, slot_field
+from metrics import Metrics
+
+# Lower runs first: releasing frees holds a queued reservation may need
+PRIORITIES = {"cancel": 0, "reserve": 1, "upgrade": 2}
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class BookingDaemon(BatchRunner):
+    def __init__(self, config: configparser.ConfigParser, metrics: Metrics = None):
+        """ Create a daemon for the providers declared in config. Call
+        start() to begin accepting operations.
+
+        Args:
+            config: The parsed api.ini, with a section (url and key) for
+                each provider and client settings in [global].
+            metrics: A Metrics to report every request to.
+        """
+        super().__init__(config, workers=1, metrics=metrics)
+        self.loop     = asyncio.new_event_loop()
+        self._writes  = None
+        self._order   = itertools.count()
+        self._pending = 0
+        self._thread  = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_writer(), self.loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    async def _start_writer(self):
+        self._writes = asyncio.PriorityQueue()
+        self._writer = self.loop.create_task(self._write_loop())
+
+    async def _shutdown(self):
+        self._writer.cancel()
+        await asyncio.gather(self._writer, return_exceptions=True)
+        await self.close()
+
+    async def _write_loop(self):
+        while True:
+            _, _, operation, future = await self._writes.get()
+            try:
+                result = await operation()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._pending -= 1
+
+    async def _enqueue(self, kind: str, operation):
+        """Queue a write behind any of higher priority and wait for it"""
+        future = self.loop.create_future()
+        self._pending += 1
+        await self._writes.put((PRIORITIES[kind], next(self._order), operation, future))
+        return await future
+
+    def call(self, coro):
+        """Run a coroutine on the daemon's loop from a request thread"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def held(self, job: dict) -> dict:
+        services = self.services(job)
+        held = await asyncio.gather(*(api.get_slots_held() for _, api in services))
+        return {name: [slot["id"] for slot in slots]
+                for (name, _), slots in zip(services, held)}
+
+    async def available(self, job: dict) -> dict:
+        services = self.services(job)
+        limit = int(number_field(job, "limit", 20))
+        available = await asyncio.gather(
+            *(api.get_slot_ids_available() for _, api in services))
+        return {name: list(ids[:limit])
+                for (name, _), ids in zip(services, available)}
+
+    async def matching_slots(self, job: dict) -> list:
+        limit = int(number_field(job, "limit", 5))
+        slots = await self.matching(self.services(job), job_constraints(job))
+        return slots[:limit]
+
+    async def reserve(self, job: dict) -> dict:
+        services = self.services(job)
+        if "slot" in job:
+            return await self._enqueue("reserve", lambda: self.reserve_specific(job, services))
+        return await self._enqueue("reserve", lambda: self.reserve_earliest(job, services))
+
+    async def cancel_slots(self, job: dict) -> dict:
+        services = self.services(job)
+        return await self._enqueue("cancel", lambda: self.cancel(job, services))
+
+    async def upgrade(self, job: dict) -> dict:
+        services = self.services(job)
+        current = slot_field(job, "slot")
+        constraints = job_constraints(job)
+
+        async def step():
+            better = await self.upgrade_step(services, current, constraints)
+            return {"slot": better or current, "upgraded": better is not None}
+        return await self._enqueue("upgrade", step)
+
+    def status(self) -> dict:
+        return {"providers": self.providers, "clients": len(self._clients),
+                "queued_writes": self._pending, "cache": self.cache.stats()}
+
+    def handle(self, method: str, path: str, body: bytes):
+        """Serve one request, returning (status, JSON body or text)"""
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        try:
+            job = json.loads(body) if body else {}
+            if not isinstance(job, dict):
+                raise ValueError("request body must be a JSON object")
+            tokens = {key[6:]: values[-1] for key, values in query.items()
+                      if key.startswith("token.")}
+            if tokens:
+                job["tokens"] = {**job.get("tokens", {}), **tokens}
+            constraints = job.setdefault("constraints", {})
+            for name in ("after", "before"):
+                if name in query:
+                    constraints[name] = int(query[name][-1])
+            if "limit" in query:
+                job["limit"] = int(query["limit"][-1])
+
+            route = (method, url.path.rstrip("/"))
+            if route == ("GET", "/held"):
+                return 200, self.call(self.held(job))
+            if route == ("GET", "/available"):
+                return 200, self.call(self.available(job))
+            if route == ("GET", "/matching"):
+                return 200, self.call(self.matching_slots(job))
+            if route == ("GET", "/status"):
+                return 200, self.status()
+            if route == ("GET", "/metrics"):
+                if self.metrics is None:
+                    return 404, {"message": "Metrics are disabled"}
+                return 200, self.metrics.to_prometheus()
+            if route == ("POST", "/reserve"):
+                return 200, self.call(self.reserve(job))
+            if route == ("POST", "/cancel"):
+                return 200, self.call(self.cancel_slots(job))
+            if route == ("POST", "/upgrade"):
+                return 200, self.call(self.upgrade(job))
+            return 404, {"message": f"No such operation: {method} {url.path}"}
+        except ValueError as e:
+            return 400, {"message": str(e)}
+        except JobError as e:
+            return 409, {"message": str(e)}
+        except Exception as e:
+            return 502, {"message": f"{type(e).__name__}: {e}"}
+
+    def handler(self, unix: bool = False):
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Nagle's algorithm only applies to TCP
+            disable_nagle_algorithm = not unix
+
+            def log_message(self, format, *args):
+                pass
+
+            def address_string(self):
+                # Unix socket peers have no address
+                return self.client_address[0] if self.client_address else "local"
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                status, body = daemon.handle(self.command, self.path, self.rfile.read(length))
+                if isinstance(body, str):
+                    payload, content_type = body.encode(), "text/plain; version=0.0.4"
+                else:
+                    payload, content_type = json.dumps(body).encode(), "application/json"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = _respond
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve booking operations to local tools")
+    parser.add_argument("--config", default=os.environ.get("BOOKING_CONFIG", "api.ini"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of a port")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    metrics = Metrics() if config['global'].getboolean('metrics', fallback=True) else None
+    daemon = BookingDaemon(config, metrics).start()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, daemon.handler(unix=True))
+        print(f"Listening on {args.socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), daemon.handler())
+        print(f"Listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+        if args.socket:
+            os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
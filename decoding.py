@@ -0,0 +1,81 @@
+""" JSON decoding for reservation API responses
+
+loads() uses the fastest decoder installed (orjson, then simplejson, then
+the standard library). Every decoder raises a ValueError subclass on bad
+input, so callers only need to catch ValueError.
+
+Availability responses can be very large. scan_slot_ids() pulls the slot
+IDs straight out of the raw body, chunk by chunk as it arrives, into a
+compact array of integers, without building a dict per slot. The async
+client feeds a SlotIdScanner from aiohttp's chunk iterator instead.
+"""
+
+import re
+from array import array
+
+try:
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+
+    def loads(data):
+        return json.loads(data)
+
+# The size of the chunks to read a streamed response body in
+CHUNK_SIZE = 64 * 1024
+
+# A slot's ID field, whether the server sends it as a number or a string
+_SLOT_ID = re.compile(rb'"id"\s*:\s*"?(-?\d+)')
+
+
+def message(data) -> str:
+    """The "message" field of an error response body, or None"""
+    try:
+        return loads(data)["message"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class SlotIdScanner:
+    """Collects the slot IDs from an availability response body fed to it
+    one byte chunk at a time, e.g. as an async response streams in"""
+
+    def __init__(self):
+        self.ids   = array("q")
+        self._tail = b""
+
+    def feed(self, chunk: bytes):
+        data = self._tail + chunk
+        # Everything up to the last closing brace is whole slot objects;
+        # the rest may be cut off mid-field and waits for the next chunk
+        cut = data.rfind(b"}") + 1
+        self.ids.extend(map(int, _SLOT_ID.findall(data, 0, cut)))
+        self._tail = data[cut:]
+
+    def finish(self) -> array:
+        """The slot IDs, once the last chunk has been fed"""
+        self.ids.extend(map(int, _SLOT_ID.findall(self._tail)))
+        self._tail = b""
+        return self.ids
+
+
+def scan_slot_ids(chunks) -> array:
+    """Collect the slot IDs from an availability response body delivered
+    as an iterable of byte chunks"""
+    scanner = SlotIdScanner()
+    for chunk in chunks:
+        scanner.feed(chunk)
+    return scanner.finish()
+
+
+def slot_id_array(data) -> array:
+    """Collect the slot IDs from a complete availability response body"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return scan_slot_ids((data,))
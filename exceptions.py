@@ -2,7 +2,8 @@
 exceptions
 ~~~~~~~~~~
 This module contains exceptions that are thrown by the ReservationApi
-when the API responds with a non-200 or 5xx error
+when the API responds with a non-200 or 5xx error, or when a service is
+failing and no further requests are being sent to it
 """
 
 from requests.exceptions import RequestException
@@ -30,3 +31,15 @@ class SlotUnavailableError(RequestException):
 # 451 error
 class ReservationLimitError(RequestException):
     """The client already holds the maximum number of reservations."""
+
+# Retries exhausted on 5xx errors or connection failures
+class RetriesExceededError(RequestException):
+    """The request still failed after the maximum number of attempts."""
+
+# Circuit breaker open
+class CircuitOpenError(RequestException):
+    """The service has failed repeatedly and is not being contacted."""
+
+# Overall deadline passed
+class DeadlineExceededError(RequestException):
+    """The request did not complete, retries included, within its deadline."""
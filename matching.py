@@ -0,0 +1,213 @@
+""" Indexes of slots free with every provider
+
+MatchingIndex takes successive availability snapshots from each provider
+and applies only what changed since the previous one, keeping the slots
+free everywhere in a sorted list. Earliest-match and "anything better
+than my slot" queries are then O(1), top-k is O(k), and membership is a
+binary search, instead of rebuilding and sorting the intersection on
+every poll.
+
+BitmapIndex answers the same queries from per-provider bitsets, so the
+k-way intersection over any number of providers is a handful of
+word-wide ANDs. NumPy is used to build the bitsets when it is installed.
+"""
+
+import threading
+from array import array
+from bisect import bisect_left, insort
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def slot_ids(slots) -> set:
+    """The set of slot IDs in an availability response, either as
+    returned by get_slots_available or by get_slot_ids_available"""
+    if isinstance(slots, array):
+        return set(slots)
+    return {int(slot["id"]) for slot in slots}
+
+
+class MatchingIndex:
+    def __init__(self, providers):
+        """ Create an empty index.
+
+        Args:
+            providers: The names of the providers a slot must be free with.
+        """
+        self.providers = tuple(providers)
+        self.version   = 0
+        self._slots    = {name: set() for name in self.providers}
+        self._raw      = dict.fromkeys(self.providers)
+        self._matching = []
+        self._lock     = threading.Lock()
+
+    def update(self, provider: str, slots) -> bool:
+        """Apply an availability response from provider, returning True if
+        the set of matching slots changed"""
+        # A cached response is handed back as the same object, in which
+        # case nothing can have changed.
+        if slots is self._raw[provider]:
+            return False
+        changed = self.update_ids(provider, slot_ids(slots))
+        self._raw[provider] = slots
+        return changed
+
+    def update_ids(self, provider: str, ids) -> bool:
+        """Apply the set of slot IDs now free with provider, returning True
+        if the set of matching slots changed"""
+        ids = ids if isinstance(ids, (set, frozenset)) else set(ids)
+        with self._lock:
+            old = self._slots[provider]
+            added = ids - old
+            removed = old - ids
+            self._slots[provider] = ids
+            self._raw[provider] = None
+            if not added and not removed:
+                return False
+
+            before = len(self._matching)
+            if len(added) + len(removed) > before // 4 + 16:
+                # Most of the index changed (e.g. the first snapshot), so
+                # one sort beats many insertions.
+                self._matching = sorted(set.intersection(
+                    *(self._slots[name] for name in self.providers)))
+                changed = True
+            else:
+                changed = False
+                others = [self._slots[name] for name in self.providers
+                          if name != provider]
+                for slot in removed:
+                    i = bisect_left(self._matching, slot)
+                    if i < len(self._matching) and self._matching[i] == slot:
+                        del self._matching[i]
+                        changed = True
+                for slot in added:
+                    if all(slot in other for other in others):
+                        insort(self._matching, slot)
+                        changed = True
+            if changed:
+                self.version += 1
+            return changed
+
+    def earliest(self):
+        """The earliest slot free with every provider, or None"""
+        matching = self._matching
+        return matching[0] if matching else None
+
+    def top(self, k: int) -> list:
+        """The k earliest slots free with every provider"""
+        return self._matching[:k]
+
+    def better_than(self, slot_id: int):
+        """The earliest matching slot before slot_id, or None if slot_id is
+        already the best available"""
+        earliest = self.earliest()
+        if earliest is not None and earliest < slot_id:
+            return earliest
+        return None
+
+    def __contains__(self, slot_id) -> bool:
+        matching = self._matching
+        i = bisect_left(matching, slot_id)
+        return i < len(matching) and matching[i] == slot_id
+
+    def __len__(self) -> int:
+        return len(self._matching)
+
+
+def slot_bitmap(slots) -> int:
+    """A bitset (bit n set when slot n is free) from an availability
+    response or an iterable of slot IDs"""
+    if not isinstance(slots, array) and not isinstance(slots, (set, frozenset)):
+        slots = slot_ids(slots)
+    if not slots:
+        return 0
+    if numpy is not None:
+        ids = numpy.frombuffer(slots, dtype=numpy.int64) if isinstance(slots, array) \
+            else numpy.fromiter(slots, dtype=numpy.int64, count=len(slots))
+        bits = numpy.zeros(int(ids.max()) + 1, dtype=bool)
+        bits[ids] = True
+        return int.from_bytes(numpy.packbits(bits, bitorder="little").tobytes(), "little")
+    bits = bytearray(max(slots) // 8 + 1)
+    for slot in slots:
+        bits[slot >> 3] |= 1 << (slot & 7)
+    return int.from_bytes(bits, "little")
+
+
+class BitmapIndex:
+    def __init__(self, providers):
+        """ Create an empty index over any number of providers, holding
+        each provider's availability as a bitset so that finding the slots
+        free everywhere is one AND per provider over machine words.
+
+        Args:
+            providers: The names of the providers a slot must be free with.
+        """
+        self.providers = tuple(providers)
+        self.version   = 0
+        self._bitmaps  = dict.fromkeys(self.providers, 0)
+        self._raw      = dict.fromkeys(self.providers)
+        self._matching = 0
+        self._lock     = threading.Lock()
+
+    def update(self, provider: str, slots) -> bool:
+        """Apply an availability response (or array of slot IDs) from
+        provider, returning True if the set of matching slots changed"""
+        if slots is self._raw[provider]:
+            return False
+        changed = self.update_bitmap(provider, slot_bitmap(slots))
+        self._raw[provider] = slots
+        return changed
+
+    def update_ids(self, provider: str, ids) -> bool:
+        """Apply the slot IDs now free with provider"""
+        ids = ids if isinstance(ids, (array, set, frozenset)) else set(ids)
+        return self.update_bitmap(provider, slot_bitmap(ids))
+
+    def update_bitmap(self, provider: str, bitmap: int) -> bool:
+        """Apply a bitset of the slots now free with provider"""
+        with self._lock:
+            self._raw[provider] = None
+            if bitmap == self._bitmaps[provider]:
+                return False
+            self._bitmaps[provider] = bitmap
+            matching = -1
+            for name in self.providers:
+                matching &= self._bitmaps[name]
+            if matching == self._matching:
+                return False
+            self._matching = matching
+            self.version += 1
+            return True
+
+    def earliest(self):
+        """The earliest slot free with every provider, or None"""
+        matching = self._matching
+        return (matching & -matching).bit_length() - 1 if matching else None
+
+    def top(self, k: int) -> list:
+        """The k earliest slots free with every provider"""
+        slots = []
+        matching = self._matching
+        while matching and len(slots) < k:
+            lowest = matching & -matching
+            slots.append(lowest.bit_length() - 1)
+            matching ^= lowest
+        return slots
+
+    def better_than(self, slot_id: int):
+        """The earliest matching slot before slot_id, or None if slot_id is
+        already the best available"""
+        earliest = self.earliest()
+        if earliest is not None and earliest < slot_id:
+            return earliest
+        return None
+
+    def __contains__(self, slot_id) -> bool:
+        return slot_id >= 0 and bool(self._matching >> slot_id & 1)
+
+    def __len__(self) -> int:
+        return bin(self._matching).count("1")
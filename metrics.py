@@ -0,0 +1,193 @@
+""" Request metrics for the reservation API clients
+
+Metrics collects, per host and endpoint, request counts by outcome
+(status code or exception class), latency histograms, retries, hedged
+requests, cache hits and misses, and the time spent deliberately waiting
+(rate limiting and retry backoff). Clients only touch it when one is passed in, so
+leaving metrics off costs a single None check per event.
+
+snapshot() returns everything as a dict; to_json() and to_prometheus()
+export it.
+"""
+
+import json
+import re
+import threading
+from bisect import bisect_left
+from collections import deque
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Slot IDs would give every slot its own series
+_SLOT = re.compile(r"/reservation/(?!available$)[^/]+$")
+
+
+def endpoint_label(endpoint: str) -> str:
+    """Collapse slot IDs so that endpoints form a small fixed set"""
+    return _SLOT.sub("/reservation/{id}", endpoint)
+
+
+class _Series:
+    """Everything recorded for one host and endpoint"""
+
+    def __init__(self):
+        self.outcomes = {}
+        self.buckets  = [0] * (len(BUCKETS) + 1)
+        self.sum      = 0.0
+        self.count    = 0
+        self.retries  = 0
+        self.hedges   = 0
+        self.hits     = 0
+        self.misses   = 0
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        """ Track recent latencies per endpoint, to tell when a request is
+        slower than usual.
+
+        Args:
+            window: The number of recent latencies kept per endpoint.
+            min_samples: The number needed before percentiles are given.
+        """
+        self.window      = window
+        self.min_samples = min_samples
+        self._samples    = {}
+        self._lock       = threading.Lock()
+
+    def observe(self, endpoint: str, latency: float):
+        endpoint = endpoint_label(endpoint)
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append(latency)
+
+    def percentile(self, endpoint: str, p: float):
+        """The p-th percentile of recent latencies for endpoint, or None
+        if too few have been seen"""
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint_label(endpoint), ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+
+class Metrics:
+    def __init__(self):
+        self._series = {}
+        self._waits  = {}
+        self._lock   = threading.Lock()
+
+    def _get(self, host: str, endpoint: str) -> _Series:
+        key = (host.rstrip("/"), endpoint_label(endpoint))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series()
+        return series
+
+    def request(self, host: str, endpoint: str, outcome, latency: float):
+        """Record one request attempt and how it ended"""
+        outcome = str(outcome)
+        with self._lock:
+            series = self._get(host, endpoint)
+            series.outcomes[outcome] = series.outcomes.get(outcome, 0) + 1
+            series.buckets[bisect_left(BUCKETS, latency)] += 1
+            series.sum += latency
+            series.count += 1
+
+    def retry(self, host: str, endpoint: str):
+        with self._lock:
+            self._get(host, endpoint).retries += 1
+
+    def hedge(self, host: str, endpoint: str):
+        with self._lock:
+            self._get(host, endpoint).hedges += 1
+
+    def cache(self, host: str, endpoint: str, hit: bool):
+        with self._lock:
+            series = self._get(host, endpoint)
+            if hit:
+                series.hits += 1
+            else:
+                series.misses += 1
+
+    def wait(self, host: str, kind: str, seconds: float):
+        """Record time spent deliberately waiting, e.g. kind "rate_limit"
+        or "backoff\""""
+        key = (host.rstrip("/"), kind)
+        with self._lock:
+            self._waits[key] = self._waits.get(key, 0.0) + seconds
+
+    def snapshot(self) -> dict:
+        """A copy of everything recorded, keyed by host then endpoint"""
+        hosts = {}
+        with self._lock:
+            for (host, endpoint), s in self._series.items():
+                lookups = s.hits + s.misses
+                hosts.setdefault(host, {"endpoints": {}, "waits": {}})
+                hosts[host]["endpoints"][endpoint] = {
+                    "requests": dict(s.outcomes),
+                    "latency": {"buckets": dict(zip([*map(str, BUCKETS), "+Inf"],
+                                                    s.buckets)),
+                                "sum": s.sum, "count": s.count},
+                    "retries": s.retries,
+                    "hedges": s.hedges,
+                    "cache": {"hits": s.hits, "misses": s.misses,
+                              "hit_ratio": s.hits / lookups if lookups else 0.0},
+                }
+            for (host, kind), seconds in self._waits.items():
+                hosts.setdefault(host, {"endpoints": {}, "waits": {}})
+                hosts[host]["waits"][kind] = seconds
+        return hosts
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """Render the metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP reservation_requests_total Request attempts by outcome.",
+            "# TYPE reservation_requests_total counter",
+        ]
+        snapshot = self.snapshot()
+        series = [(host, endpoint, data)
+                  for host, entry in snapshot.items()
+                  for endpoint, data in entry["endpoints"].items()]
+        for host, endpoint, data in series:
+            for outcome, count in data["requests"].items():
+                lines.append(f'reservation_requests_total{{host="{host}",endpoint="{endpoint}",outcome="{outcome}"}} {count}')
+
+        lines += ["# HELP reservation_request_seconds Request attempt latency.",
+                  "# TYPE reservation_request_seconds histogram"]
+        for host, endpoint, data in series:
+            cumulative = 0
+            for le, count in data["latency"]["buckets"].items():
+                cumulative += count
+                lines.append(f'reservation_request_seconds_bucket{{host="{host}",endpoint="{endpoint}",le="{le}"}} {cumulative}')
+            lines.append(f'reservation_request_seconds_sum{{host="{host}",endpoint="{endpoint}"}} {data["latency"]["sum"]}')
+            lines.append(f'reservation_request_seconds_count{{host="{host}",endpoint="{endpoint}"}} {data["latency"]["count"]}')
+
+        lines += ["# HELP reservation_retries_total Requests retried after a failure.",
+                  "# TYPE reservation_retries_total counter"]
+        for host, endpoint, data in series:
+            lines.append(f'reservation_retries_total{{host="{host}",endpoint="{endpoint}"}} {data["retries"]}')
+
+        lines += ["# HELP reservation_hedges_total Reads sent a second time because the first was slow.",
+                  "# TYPE reservation_hedges_total counter"]
+        for host, endpoint, data in series:
+            lines.append(f'reservation_hedges_total{{host="{host}",endpoint="{endpoint}"}} {data["hedges"]}')
+
+        lines += ["# HELP reservation_cache_lookups_total Cached reads by result.",
+                  "# TYPE reservation_cache_lookups_total counter"]
+        for host, endpoint, data in series:
+            for result, field in (("hit", "hits"), ("miss", "misses")):
+                lines.append(f'reservation_cache_lookups_total{{host="{host}",endpoint="{endpoint}",result="{result}"}} {data["cache"][field]}')
+
+        lines += ["# HELP reservation_wait_seconds_total Time spent deliberately waiting.",
+                  "# TYPE reservation_wait_seconds_total counter"]
+        for host, entry in snapshot.items():
+            for kind, seconds in entry["waits"].items():
+                lines.append(f'reservation_wait_seconds_total{{host="{host}",kind="{kind}"}} {seconds}')
+        return "\n".join(lines) + "\n"
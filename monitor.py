@@ -0,0 +1,109 @@
+""" Background upgrade monitor
+
+UpgradeMonitor polls for a matching slot earlier than the one currently
+held and upgrades to it, running as a task on an asyncio event loop so
+the caller is never blocked. The poll interval adapts: it drops to
+min_interval whenever availability changes or a better slot is seen, and
+doubles up to max_interval while nothing changes. Requests go through the
+same clients (and so the same rate limiters and cache) as everything
+else.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+from tracing import span
+
+
+class UpgradeMonitor:
+    def __init__(self, fetch, upgrade, min_interval: float = 2.0,
+                 max_interval: float = 30.0, on_upgrade=None):
+        """ Create a stopped monitor.
+
+        Args:
+            fetch: A coroutine function returning an up to date
+                MatchingIndex.
+            upgrade: A coroutine function upgrade(old, new, log) that moves
+                the booking from slot old to slot new and returns True on
+                success.
+            min_interval: Seconds between polls while availability changes.
+            max_interval: The longest the interval backs off to.
+            on_upgrade: Called with the new slot after each upgrade.
+        """
+        self.fetch        = fetch
+        self.upgrade      = upgrade
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.on_upgrade   = on_upgrade
+        self.current_slot = None
+        self.interval     = min_interval
+        self.polls        = 0
+        self.upgrades     = 0
+        self.events       = deque(maxlen=20)
+        self._future      = None
+
+    @property
+    def running(self) -> bool:
+        return self._future is not None and not self._future.done()
+
+    def log(self, message: str):
+        """Record an event for status(); the monitor never prints"""
+        self.events.append(f"{time.strftime('%H:%M:%S')} {message}")
+
+    def start(self, loop, current_slot: int):
+        """Start monitoring current_slot on loop, which runs in another
+        thread"""
+        if self.running:
+            return
+        self.current_slot = current_slot
+        self._future = asyncio.run_coroutine_threadsafe(self._run(), loop)
+
+    def stop(self):
+        if self.running:
+            self._future.cancel()
+            self.log("Monitoring stopped.")
+
+    def status(self) -> dict:
+        return {"running": self.running, "current_slot": self.current_slot,
+                "interval": self.interval, "polls": self.polls,
+                "upgrades": self.upgrades, "events": list(self.events)}
+
+    async def _run(self):
+        self.log(f"Monitoring started for slot {self.current_slot}.")
+        self.interval = self.min_interval
+        last_version = None
+        failed = None
+        while True:
+            with span("upgrade poll", slot=self.current_slot) as poll:
+                try:
+                    index = await self.fetch()
+                    changed = index.version != last_version
+                    last_version = index.version
+                    better = index.better_than(self.current_slot)
+                    poll.set(outcome="no upgrade")
+                    # Don't retry an upgrade that just failed until the
+                    # availability it was based on has changed
+                    if better is not None and (better, index.version) != failed:
+                        changed = True
+                        self.log(f"Better slot found: {better} (current reserved: {self.current_slot})")
+                        if await self.upgrade(self.current_slot, better, self.log):
+                            poll.set(outcome="upgraded", upgraded_to=better)
+                            self.current_slot = better
+                            self.upgrades += 1
+                            if self.on_upgrade is not None:
+                                self.on_upgrade(better)
+                        else:
+                            poll.set(outcome="upgrade failed", upgraded_to=better)
+                            failed = (better, index.version)
+                    # Poll quickly while things are moving, back off when idle
+                    if changed:
+                        self.interval = self.min_interval
+                    else:
+                        self.interval = min(self.interval * 2, self.max_interval)
+                except Exception as e:
+                    poll.set(outcome=type(e).__name__)
+                    self.log(f"Error during upgrade monitoring: {e}")
+                    self.interval = min(self.interval * 2, self.max_interval)
+            self.polls += 1
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,105 @@
+""" Per-host rate limiting
+
+This module implements a token bucket used by ReservationApi and
+AsyncReservationApi to honour the servers' request-rate rule. The rule
+applies to each API token separately, so a bucket is shared by every client
+of the same base URL and token, and a caller is only held back when its
+request would otherwise break the rule.
+"""
+
+import asyncio
+import threading
+import time
+
+# Buckets shared between clients, keyed by normalised base URL and token so
+# that each service, and each user of it, is limited independently.
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1.0,
+                 headroom: float = 0.1):
+        """ Create a token bucket.
+
+        Args:
+            rate: The number of requests per second to allow.
+            capacity: The number of requests that may be sent back to back
+                after a quiet period.
+            headroom: The fraction of rate left unused. Requests spaced
+                exactly 1/rate apart when sent can arrive closer together,
+                which a server counts as breaking the rule, so the spacing
+                must leave room for network and scheduling jitter.
+        """
+        self.rate     = rate
+        self.capacity = capacity
+        self.headroom = headroom
+        self._rate    = rate * (1 - headroom)
+        self.waited   = 0.0
+        self.waits    = 0
+        self._tokens  = capacity
+        self._updated = time.monotonic()
+        self._lock    = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Take a token and return how long the caller must wait before
+        it may be used. The bucket may go into debt, which queues callers
+        in the order they arrived."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            wait = -self._tokens / self._rate
+            self.waited += wait
+            self.waits  += 1
+            return wait
+
+    def try_acquire(self) -> bool:
+        """Take a token only if one is free right now, for optional
+        requests (such as hedges) that should never wait or queue"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def acquire(self) -> float:
+        """Block until a request may be sent, returning the seconds waited"""
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        """Wait without blocking the event loop until a request may be
+        sent, returning the seconds waited"""
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def stats(self) -> dict:
+        """Report how often and for how long callers have been held back"""
+        with self._lock:
+            return {"rate": self.rate, "waits": self.waits,
+                    "waited": self.waited}
+
+
+def limiter_for(base_url: str, rate: float, capacity: float = 1.0,
+                token: str = None, headroom: float = 0.1) -> TokenBucket:
+    """Return the bucket shared by every client of base_url using token,
+    creating it with the given rate and headroom on first use."""
+    key = (base_url.rstrip("/"), token)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = TokenBucket(rate, capacity, headroom)
+        return limiter
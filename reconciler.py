@@ -0,0 +1,162 @@
+""" Held-slot reconciler
+
+Reconciler releases orphaned holds: holds this process meant to release
+(rolling back a partial booking, dropping the losers of a speculative
+booking or the slot upgraded from) but whose release failed. Each failure
+is recorded with owe(). Orphans use up the reservation limit, so they are
+released in bulk with release_many, pipelined within each service's rate
+limit.
+
+Only recorded holds are ever released. Slots held before the process
+started, or by other tools using the same keys, are not its business,
+even when they are held with only some services. A recorded slot that is
+now held with every service has become a complete booking and is left
+alone, as is the slot the caller intends to keep and any slot a booking is
+working on at that moment.
+
+It runs as a task on an asyncio event loop, every interval seconds and
+whenever trigger() is called, e.g. after a compensating release failed.
+A pass with nothing recorded sends no requests.
+"""
+
+import asyncio
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+
+class Reconciler:
+    def __init__(self, services, intended, interval: float = 60.0):
+        """ Create a stopped reconciler.
+
+        Args:
+            services: (name, AsyncReservationApi) pairs for every service a
+                slot is booked with.
+            intended: A function returning the slot IDs to keep even if
+                they are only partly held.
+            interval: Seconds between passes.
+        """
+        self.services  = services
+        self.intended  = intended
+        self.interval  = interval
+        self.passes    = 0
+        self.reclaimed = 0
+        self.events    = deque(maxlen=20)
+        self.owed      = set()
+        self._busy     = Counter()
+        self._lock     = None
+        self._wake     = None
+        self._future   = None
+        self._triggered = None
+
+    @property
+    def running(self) -> bool:
+        return self._future is not None and not self._future.done()
+
+    def log(self, message: str):
+        """Record an event for status(); the reconciler never prints"""
+        self.events.append(f"{time.strftime('%H:%M:%S')} {message}")
+
+    def start(self, loop):
+        """Start reconciling periodically on loop, which runs in another
+        thread"""
+        if not self.running:
+            self._future = asyncio.run_coroutine_threadsafe(self._run(), loop)
+
+    def stop(self):
+        if self.running:
+            self._future.cancel()
+
+    def status(self) -> dict:
+        return {"running": self.running, "interval": self.interval,
+                "passes": self.passes, "reclaimed": self.reclaimed,
+                "owed": len(self.owed), "events": list(self.events)}
+
+    def owe(self, name: str, slot_id):
+        """Record that releasing slot_id with the service called name
+        failed, so the hold may have been left behind"""
+        self.owed.add((name, str(slot_id)))
+
+    @contextmanager
+    def protect(self, *slot_ids):
+        """Keep slot_ids from being reclaimed while a booking is reserving
+        or releasing them, when they may be held with only some services"""
+        slot_ids = [str(slot_id) for slot_id in slot_ids]
+        self._busy.update(slot_ids)
+        try:
+            yield
+        finally:
+            self._busy.subtract(slot_ids)
+            self._busy += Counter()
+
+    def trigger(self):
+        """Run a pass as soon as possible. Must be called from the event
+        loop."""
+        if self.running and self._wake is not None:
+            self._wake.set()
+        elif self._triggered is None or self._triggered.done():
+            # Keep a reference, or the task may be collected before it runs
+            self._triggered = asyncio.ensure_future(self._pass())
+
+    async def reconcile(self) -> list:
+        """Release every recorded orphaned hold that is still held,
+        returning the (name, slot ID) pairs reclaimed"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self.passes += 1
+            if not self.owed:
+                return []
+            # The failed write may have succeeded after all, so don't trust
+            # what the cache saw before it
+            for _, api in self.services:
+                if api.cache is not None:
+                    api.cache.invalidate(api.base_url)
+            held = await asyncio.gather(*(api.get_slots_held() for _, api in self.services))
+            holders = {}
+            for (name, _), slots in zip(self.services, held):
+                for slot in slots:
+                    holders.setdefault(str(slot["id"]), set()).add(name)
+            apis = dict(self.services)
+            keep = {str(slot_id) for slot_id in self.intended() if slot_id is not None}
+            orphans = {}
+            for name, slot_id in sorted(self.owed):
+                held_by = holders.get(slot_id, set())
+                if name not in held_by:
+                    # Released after all, or by someone else
+                    self.owed.discard((name, slot_id))
+                elif len(held_by) == len(self.services):
+                    self.owed.discard((name, slot_id))
+                    self.log(f"Kept slot {slot_id}, now held with every service.")
+                elif slot_id not in keep and slot_id not in self._busy:
+                    orphans.setdefault(name, []).append(slot_id)
+
+            results = await asyncio.gather(
+                *(apis[name].release_many(slot_ids) for name, slot_ids in orphans.items()))
+            reclaimed = []
+            for name, released in zip(orphans, results):
+                for slot_id, result in released.items():
+                    if isinstance(result, Exception):
+                        self.log(f"Could not reclaim orphaned {name.lower()} hold on slot {slot_id}: {result}")
+                    else:
+                        self.owed.discard((name, slot_id))
+                        reclaimed.append((name, int(slot_id)))
+                        self.log(f"Reclaimed orphaned {name.lower()} hold on slot {slot_id}.")
+            self.reclaimed += len(reclaimed)
+            return reclaimed
+
+    async def _pass(self):
+        try:
+            await self.reconcile()
+        except Exception as e:
+            self.log(f"Error during reconciliation: {e}")
+
+    async def _run(self):
+        self._wake = asyncio.Event()
+        while True:
+            await self._pass()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
@@ -0,0 +1,160 @@
+""" Record and replay reservation API traffic
+
+TrafficRecorder streams one JSON line per request attempt made by a
+ReservationApi or AsyncReservationApi: method, URL, status (or exception),
+body, latency and attempt number. Lines are queued and written by a
+background thread, so recording adds no file I/O to the request path.
+
+ReplayTransport serves a recording back, in order, for each method and
+URL, sleeping for the recorded latency multiplied by speed (0 replays
+instantly). ReplayAdapter mounts it on a requests session; an
+AsyncReservationApi takes it directly.
+"""
+
+import asyncio
+import io
+import json
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from http import HTTPStatus
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+class TrafficRecorder:
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        """ Start recording to path, appending if it already exists.
+
+        Args:
+            path: The JSONL file to write.
+            flush_interval: The longest a line waits before being written.
+        """
+        self.path           = path
+        self.flush_interval = flush_interval
+        self.recorded       = 0
+        self._queue         = queue.SimpleQueue()
+        self._closed        = False
+        self._writer        = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    def record(self, method: str, url: str, attempt: int, latency: float,
+               status: int = None, body: str = None, headers: dict = None,
+               error: BaseException = None):
+        """Queue one request attempt to be written"""
+        entry = {"ts": time.time(), "method": method, "url": url,
+                 "attempt": attempt, "latency": round(latency, 6),
+                 "status": status, "body": body}
+        if headers:
+            entry["headers"] = headers
+        if error is not None:
+            entry["error"] = type(error).__name__
+            entry["message"] = str(error)
+        self._queue.put(entry)
+
+    def _write(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                try:
+                    entry = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    f.flush()
+                    continue
+                if entry is None:
+                    break
+                f.write(json.dumps(entry) + "\n")
+                self.recorded += 1
+            f.flush()
+
+    def close(self):
+        """Write everything still queued and stop the writer"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._writer.join()
+
+
+class ReplayTransport:
+    def __init__(self, path: str, speed: float = 1.0, loop: bool = False):
+        """ Load a recording to serve back.
+
+        Args:
+            path: The JSONL file written by TrafficRecorder.
+            speed: Multiplier for the recorded latencies; 0 to replay
+                without waiting.
+            loop: Start again from the first response for a method and URL
+                once its recording runs out, instead of failing.
+        """
+        self.speed     = speed
+        self.loop      = loop
+        self._recorded = defaultdict(list)
+        self._pending  = {}
+        self._lock     = threading.Lock()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._recorded[(entry["method"], entry["url"])].append(entry)
+
+    def _take(self, method: str, url: str) -> dict:
+        """Return the next recorded attempt for method and url"""
+        key = (method, url)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None or (not pending and self.loop):
+                pending = self._pending[key] = deque(self._recorded.get(key, ()))
+            if not pending:
+                raise requests.ConnectionError(
+                    f"No recorded response for {method} {url}")
+            return pending.popleft()
+
+    @staticmethod
+    def _result(entry: dict):
+        """Turn a recorded attempt into (status, body, headers), raising a
+        ConnectionError if it failed without a response"""
+        if entry["status"] is None:
+            raise requests.ConnectionError(
+                f"Replayed {entry.get('error', 'error')}: {entry.get('message', '')}")
+        return entry["status"], entry["body"] or "", entry.get("headers", {})
+
+    def respond(self, method: str, url: str):
+        """Replay the next attempt for method and url as (status, body,
+        headers) after its scaled latency"""
+        entry = self._take(method, url)
+        if self.speed:
+            time.sleep(entry["latency"] * self.speed)
+        return self._result(entry)
+
+    async def respond_async(self, method: str, url: str):
+        """Coroutine version of respond"""
+        entry = self._take(method, url)
+        if self.speed:
+            await asyncio.sleep(entry["latency"] * self.speed)
+        return self._result(entry)
+
+
+class ReplayAdapter(BaseAdapter):
+    """A requests transport adapter answering from a ReplayTransport"""
+
+    def __init__(self, transport: ReplayTransport):
+        super().__init__()
+        self.transport = transport
+
+    def send(self, request, **kwargs):
+        status, body, headers = self.transport.respond(request.method, request.url)
+        response = requests.Response()
+        response.status_code = status
+        response.reason = HTTPStatus(status).phrase
+        response.headers = CaseInsensitiveDict(headers)
+        # Served from raw like a real response, so streamed reads work too
+        response.raw = io.BytesIO(body.encode("utf-8"))
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
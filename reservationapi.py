@@ -1,8 +1,8 @@
 """ Reservation API wrapper
 
 This class implements a simple wrapper around the reservation API. It
-provides automatic retries for server-side errors, delays to prevent
-server overloading, and produces sensible exceptions for the different
+provides automatic retries for server-side errors, per-host rate limiting to
+prevent server overloading, and produces sensible exceptions for the different
 types of client-side error that can be encountered.
 """
 
@@ -11,20 +11,260 @@ types of client-side error that can be encountered.
 # Comments are included to provide hints about what you should do.
 
 import requests
-try:
-    import simplejson as json
-except ImportError:
-    import json
+import asyncio
+import random
 import warnings
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from urllib.parse import urlsplit
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from ratelimit import limiter_for
+from breaker import breaker_for, OPEN
+from cache import ResponseCache
+from recorder import TrafficRecorder, ReplayTransport, ReplayAdapter
+from metrics import LatencyTracker, Metrics, endpoint_label
+from tracing import _NO_SPAN, enabled, span
+from decoding import (CHUNK_SIZE, SlotIdScanner, loads, message, scan_slot_ids,
+                      slot_id_array)
 from exceptions import (
     BadRequestError, InvalidTokenError, BadSlotError, NotProcessedError,
-    SlotUnavailableError,ReservationLimitError)
-
-class ReservationApi:
-    def __init__(self, base_url: str, token: str, retries: int, delay: float):
+    SlotUnavailableError,ReservationLimitError, RetriesExceededError,
+    DeadlineExceededError)
+
+# Client errors that are meaningful to the caller, by HTTP status code
+STATUS_ERRORS = {
+    400: BadRequestError,
+    401: InvalidTokenError,
+    403: BadSlotError,
+    404: NotProcessedError,
+    409: SlotUnavailableError,
+    451: ReservationLimitError,
+}
+
+def retry_after(value) -> float:
+    """Convert a Retry-After header (seconds or an HTTP date) into seconds,
+    or None if it is missing or malformed"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def throttled(status: int, hint: float) -> bool:
+    """Whether a response is the server holding back this caller (a 503
+    with Retry-After) rather than failing. Throttling is per token, so it
+    must not count towards the host's circuit breaker."""
+    return status == 503 and hint is not None
+
+
+def endpoint_timeouts(settings) -> dict:
+    """Per-endpoint (connect, read) timeouts from the timeout_available,
+    timeout_held and timeout_write settings of api.ini, each written as
+    "connect, read" in seconds"""
+    timeouts = {}
+    for name, endpoint in (("timeout_available", "/reservation/available"),
+                           ("timeout_held", "/reservation"),
+                           ("timeout_write", "/reservation/{id}")):
+        if settings.get(name):
+            connect, read = (float(part) for part in settings[name].split(","))
+            timeouts[endpoint] = (connect, read)
+    return timeouts
+
+
+def _discard(future):
+    """Close the response of a hedged request that lost the race"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def replayable_headers(headers) -> dict:
+    """The response headers that affect the client, worth recording"""
+    return {name: headers[name] for name in ("Retry-After",) if name in headers}
+
+
+def backoff(attempt: int, base: float, cap: float, hint: float = None) -> float:
+    """Seconds to wait before retry number attempt + 1.
+
+    Exponential backoff from base, capped at cap, with full jitter so
+    clients recovering from the same outage do not retry in lockstep. A
+    Retry-After hint from the server is honoured up to the cap.
+    """
+    wait = random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+    if hint is not None:
+        wait = max(wait, min(hint, cap))
+    return wait
+
+
+# Sessions shared between clients talking to the same host, keyed by
+# scheme://netloc. Services on the same host (the hotel and band in api.ini
+# both live on web.cs.manchester.ac.uk) share one pool; services on
+# different hosts or ports never do. Each entry is (session, pool size).
+_shared_sessions = {}
+_shared_sessions_lock = threading.Lock()
+
+
+def host_key(base_url: str) -> str:
+    """Reduce a base URL to the scheme://host[:port] it connects to"""
+    parts = urlsplit(base_url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def new_session(pool_size: int = 4) -> requests.Session:
+    """Create a keep-alive session with a bounded connection pool.
+
+    Retries are handled by ReservationApi itself, so the adapter is told
+    not to retry on its own.
+    """
+    session = requests.Session()
+    _mount_pool(session, pool_size)
+    session.headers.update({"Accept": "application/json",
+                            "Connection": "keep-alive"})
+    return session
+
+
+def _mount_pool(session: requests.Session, pool_size: int):
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+def shared_session(base_url: str, pool_size: int = 4) -> requests.Session:
+    """Return the session shared by every client of the host in base_url,
+    creating it on first use. The pool is sized for the client asking for
+    the most connections, growing (and dropping its idle connections) if a
+    later client asks for more than the first."""
+    key = host_key(base_url)
+    with _shared_sessions_lock:
+        session, size = _shared_sessions.get(key, (None, 0))
+        if session is None:
+            session = new_session(pool_size)
+        elif pool_size > size:
+            _mount_pool(session, pool_size)
+        _shared_sessions[key] = (session, max(size, pool_size))
+        return session
+
+
+class _ClientBookkeeping:
+    """Retry pacing, recording and metrics shared by ReservationApi and
+    AsyncReservationApi"""
+
+    def _observe(self, method: str, endpoint: str, attempt: int, start: float,
+                 status: int = None, body: str = None, headers=None,
+                 error: BaseException = None):
+        """Report a finished request attempt to the recorder, metrics and
+        latency tracker"""
+        latency = time.perf_counter() - start
+        # Only hedged reads need to know how long requests usually take
+        if self.hedge_percentile and method == "GET" and error is None and status < 500:
+            self.latencies.observe(endpoint, latency)
+        if self.recorder is not None:
+            if isinstance(body, bytes):
+                body = body.decode("utf-8", "replace")
+            self.recorder.record(method, self.base_url + endpoint, attempt,
+                                 latency, status, body,
+                                 replayable_headers(headers or {}), error)
+        if self.metrics is not None:
+            outcome = status if error is None else type(error).__name__
+            self.metrics.request(self.base_url, endpoint, outcome, latency)
+
+    def _expires(self):
+        """The time.monotonic() by which an operation started now must
+        finish, or None without a deadline"""
+        return time.monotonic() + self.deadline if self.deadline else None
+
+    def _remaining(self, expires, method: str, endpoint: str) -> float:
+        """Seconds left until expires, raising DeadlineExceededError once
+        there are none"""
+        if expires is None:
+            return None
+        left = expires - time.monotonic()
+        if left <= 0:
+            raise DeadlineExceededError(
+                f"{method} {endpoint} did not complete within {self.deadline}s")
+        return left
+
+    def _attempt_timeout(self, endpoint: str, left: float = None) -> tuple:
+        """The (connect, read) timeouts for one attempt at endpoint, cut
+        short so that the attempt cannot outlive the deadline"""
+        connect, read = self.timeouts.get(endpoint_label(endpoint), self.timeout)
+        if left is not None:
+            connect, read = min(connect, left), min(read, left)
+        return connect, read
+
+    def _pause(self, pause: float, expires, method: str, endpoint: str) -> float:
+        """pause, unless waiting that long would pass the deadline, in
+        which case fail now rather than after the wait"""
+        if expires is not None and pause and time.monotonic() + pause >= expires:
+            raise DeadlineExceededError(
+                f"{method} {endpoint} did not complete within {self.deadline}s")
+        return pause
+
+    def _hedge_after(self, method: str, endpoint: str):
+        """Seconds after which a read should be sent a second time, or
+        None if it should not be hedged"""
+        if method != "GET" or not self.hedge_percentile:
+            return None
+        return self.latencies.percentile(endpoint, self.hedge_percentile)
+
+    def _hedged(self, endpoint: str):
+        if self.metrics is not None:
+            self.metrics.hedge(self.base_url, endpoint)
+
+    def _span(self, method: str, endpoint: str):
+        """A tracing span for one request, with its host and slot"""
+        if not enabled():
+            return _NO_SPAN
+        label = endpoint_label(endpoint)
+        slot = endpoint.rsplit("/", 1)[1] if label == "/reservation/{id}" else None
+        return span(f"{method} {label}", host=self.base_url, slot=slot)
+
+    def _rate_waited(self, seconds: float):
+        """Report time spent held back by the rate limiter"""
+        if seconds and self.metrics is not None:
+            self.metrics.wait(self.base_url, "rate_limit", seconds)
+
+    def _retry_pause(self, attempt: int, endpoint: str, hint: float = None) -> float:
+        """Seconds to wait after a failed attempt. There is no point
+        waiting after the last attempt, or when the circuit has opened and
+        the next attempt will fail fast anyway."""
+        if attempt >= self.retries or self.breaker.state == OPEN:
+            return 0.0
+        pause = backoff(attempt, self.delay, self.backoff_max, hint)
+        if self.metrics is not None:
+            self.metrics.retry(self.base_url, endpoint)
+            self.metrics.wait(self.base_url, "backoff", pause)
+        return pause
+
+
+class ReservationApi(_ClientBookkeeping):
+    def __init__(self, base_url: str, token: str, retries: int, delay: float,
+                 pool_size: int = 4, connect_timeout: float = 3.05,
+                 read_timeout: float = 10.0, share_pool: bool = False,
+                 session: requests.Session = None, rate: float = 1.0,
+                 backoff_max: float = 8.0, failure_threshold: int = 5,
+                 reset_timeout: float = 30.0, cache: ResponseCache = None,
+                 recorder: TrafficRecorder = None,
+                 replay: ReplayTransport = None, metrics: Metrics = None,
+                 timeouts: dict = None, deadline: float = None,
+                 hedge_percentile: float = None, headroom: float = 0.1):
         """ Create a new ReservationApi to communicate with a reservation
         server.
 
@@ -32,12 +272,88 @@ class ReservationApi:
             base_url: The URL of the reservation API to communicate with.
             token: The user's API token obtained from the control panel.
             retries: The maximum number of attempts to make for each request.
-            delay: A delay to apply to each request to prevent server overload.
+            delay: The initial pause before retrying a failed request,
+                doubled on each further attempt.
+            pool_size: The number of keep-alive connections to keep open.
+            connect_timeout: Seconds to wait for a connection to be made.
+            read_timeout: Seconds to wait for the server to send a response.
+            share_pool: Use the session shared by all clients of this host
+                rather than a private one.
+            session: An explicit session to use, overriding share_pool.
+            rate: The requests per second allowed to this base URL, shared
+                with every other client of it using the same token.
+            backoff_max: The longest pause between retries, including any
+                Retry-After requested by the server.
+            failure_threshold: Consecutive failures after which requests to
+                this base URL fail fast with CircuitOpenError.
+            reset_timeout: Seconds to fail fast before probing the host again.
+            cache: A ResponseCache for GET requests, which may be shared
+                with other clients. Reads are not cached without one.
+            recorder: A TrafficRecorder to log every request attempt to.
+            replay: A ReplayTransport to answer requests from a recording
+                instead of the network.
+            metrics: A Metrics to report requests, retries and waits to.
+            timeouts: (connect, read) timeouts by endpoint ("/reservation",
+                "/reservation/available" or "/reservation/{id}"), for
+                endpoints that should not use connect_timeout and
+                read_timeout.
+            deadline: Seconds a whole request may take, retries, backoff
+                and rate-limit waits included, before DeadlineExceededError
+                is raised. None for no deadline.
+            hedge_percentile: Send a GET a second time once the first
+                attempt is slower than this percentile (e.g. 95) of recent
+                ones, if the rate limit has a request to spare. None to
+                never hedge.
+            headroom: The fraction of rate left unused, so that jitter
+                between sending and arrival does not break the server's
+                rate rule.
         """
         self.base_url = base_url
         self.token    = token
         self.retries  = retries
         self.delay    = delay
+        self.timeout  = (connect_timeout, read_timeout)
+        self.timeouts = dict(timeouts or {})
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.latencies = LatencyTracker()
+        self.pool_size = pool_size
+        self.backoff_max = backoff_max
+        self.limiter  = limiter_for(base_url, rate, token=token, headroom=headroom)
+        self.breaker  = breaker_for(base_url, failure_threshold, reset_timeout)
+        self.cache    = cache
+        self.recorder = recorder
+        self.metrics  = metrics
+        self._hedges  = None
+
+        if replay is not None:
+            self.session = new_session(pool_size)
+            self.session.mount("http://", ReplayAdapter(replay))
+            self.session.mount("https://", ReplayAdapter(replay))
+        elif session is not None:
+            self.session = session
+        elif share_pool:
+            self.session = shared_session(base_url, pool_size)
+        else:
+            self.session = new_session(pool_size)
+        self._owns_session = replay is not None or (session is None and not share_pool)
+
+        # The auth header never changes, so build it once rather than on
+        # every request.
+        self._auth_headers = self._headers()
+
+    def close(self):
+        """Close the connection pool, unless it is shared with others"""
+        if self._hedges is not None:
+            self._hedges.shutdown(wait=False)
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def _reason(self, req: requests.Response) -> str:
         """Obtain the reason associated with a response"""
@@ -45,15 +361,13 @@ class ReservationApi:
 
         # Try to get the JSON content, if possible, as that may contain a
         # more useful message than the status line reason
-        try:
-            json = req.json()
-            reason = json['message']
+        reason = message(req.content)
 
         # A problem occurred while parsing the body - possibly no message
         # in the body (which can happen if the API really does 500,
         # rather than generating a "fake" 500), so fall back on the HTTP
         # status line reason
-        except simplejson.errors.JSONDecodeError:
+        if reason is None:
             if isinstance(req.reason, bytes):
                 try:
                     reason = req.reason.decode('utf-8')
@@ -65,50 +379,102 @@ class ReservationApi:
         return reason
 
 
+    def _request(self, method: str, url: str, endpoint: str, timeout: tuple,
+                 stream: bool) -> requests.Response:
+        """Make one attempt. A read slower than usual is sent a second time
+        and whichever response arrives first is used."""
+        def send():
+            return self.session.request(method, url, headers=self._auth_headers,
+                                        timeout=timeout, stream=stream)
+
+        hedge_after = self._hedge_after(method, endpoint)
+        if hedge_after is None:
+            return send()
+        if self._hedges is None:
+            self._hedges = ThreadPoolExecutor(max_workers=2 * self.pool_size)
+        first = self._hedges.submit(send)
+        try:
+            return first.result(timeout=hedge_after)
+        except FutureTimeoutError:
+            pass
+        if not self.limiter.try_acquire():
+            return first.result()
+
+        self._hedged(endpoint)
+        pending = {first, self._hedges.submit(send)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((future for future in done if future.exception() is None), None)
+            if winner is not None:
+                for future in done | pending:
+                    if future is not winner:
+                        future.add_done_callback(_discard)
+                return winner.result()
+        return first.result()
+
     def _headers(self) -> dict:
         """Create the authorization token header needed for API requests"""
         # Your code goes here
         return {"Authorization": "Bearer " + self.token}
 
 
-    def _send_request(self, method: str, endpoint: str) -> dict:
+    def _send_request(self, method: str, endpoint: str,
+                      slot_ids: bool = False) -> dict:
         """Send a request to the reservation API and convert errors to
-           appropriate exceptions"""
+           appropriate exceptions. With slot_ids, the body of a successful
+           response is streamed into an array of slot IDs instead."""
         # Your code goes here
         url = self.base_url + endpoint
+        expires = self._expires()
 
         for attempt in range (1 , self.retries + 1):
+            # Fail fast while the host is known to be down, and only wait
+            # when the previous request to it was too recent.
+            self._remaining(expires, method, endpoint)
+            self.breaker.before_request()
+            with span("rate limit", host=self.base_url):
+                self._rate_waited(self.limiter.acquire())
+            timeout = self._attempt_timeout(endpoint, self._remaining(expires, method, endpoint))
+            start = time.perf_counter()
             try:
-                response = requests. request(method, url, headers = self._headers())
+                with span(f"attempt {attempt}", host=self.base_url) as attempt_span:
+                    response = self._request(method, url, endpoint, timeout, slot_ids)
+                    attempt_span.set(outcome=response.status_code)
             except Exception as e:
+                self._observe(method, endpoint, attempt, start, error=e)
+                self.breaker.record_failure()
                 warnings.warn(f"Request exception on try {attempt}/{self.retries}: {str(e)}")
-                time.sleep(self.delay)
+                with span("backoff", host=self.base_url):
+                    time.sleep(self._pause(self._retry_pause(attempt, endpoint),
+                                           expires, method, endpoint))
                 continue
 
-            time.sleep(self.delay)
-
-            if response.status_code == 200:
-                return response.json()
+            self._observe(method, endpoint, attempt, start, response.status_code,
+                          response.text if self.recorder is not None else None,
+                          response.headers)
 
-            elif 500 <= response.status_code < 600:
+            if 500 <= response.status_code < 600:
+                hint = retry_after(response.headers.get("Retry-After"))
+                if not throttled(response.status_code, hint):
+                    self.breaker.record_failure()
                 warnings.warn(f"Server error (try {attempt}/{self.retries}): {response.status_code} - {self._reason(response)}")
+                with span("backoff", host=self.base_url):
+                    time.sleep(self._pause(self._retry_pause(attempt, endpoint, hint),
+                                           expires, method, endpoint))
+                continue
+
+            self.breaker.record_success()
+            if response.status_code == 200:
+                if slot_ids:
+                    return scan_slot_ids(response.iter_content(CHUNK_SIZE))
+                return loads(response.content)
 
-            elif response.status_code == 400:
-                raise BadRequestError(self._reason(response))
-            elif response.status_code == 401:
-                raise InvalidTokenError(self._reason(response))
-            elif response.status_code == 403:
-                raise BadSlotError(self._reason(response))
-            elif response.status_code == 404:
-                raise NotProcessedError(self._reason(response))
-            elif response.status_code == 409:
-                raise SlotUnavailableError(self._reason(response))
-            elif response.status_code == 451:
-                raise ReservationLimitError(self._reason(response))
+            elif response.status_code in STATUS_ERRORS:
+                raise STATUS_ERRORS[response.status_code](self._reason(response))
             else:
                 response.raise_for_status()
 
-        raise Exception("Maximum retries exceeded, request failed.")
+        raise RetriesExceededError(f"Maximum retries exceeded, {method} {endpoint} failed.")
 
         # Allow for multiple retries if needed
             # Perform the request.
@@ -130,26 +496,373 @@ class ReservationApi:
         # exception.
 
 
+    def _get(self, endpoint: str, slot_ids: bool = False):
+        """Send a GET request, through the cache if there is one"""
+        with self._span("GET", endpoint):
+            if self.cache is None:
+                return self._send_request("GET", endpoint, slot_ids)
+            return self.cache.get_or_load(
+                self.base_url, self.token, endpoint,
+                lambda: self._send_request("GET", endpoint, slot_ids),
+                variant="ids" if slot_ids else "")
+
+    def _write(self, method: str, endpoint: str):
+        """Send a request that changes reservations. Whatever the outcome,
+        cached reads for this service can no longer be trusted."""
+        try:
+            with self._span(method, endpoint):
+                return self._send_request(method, endpoint)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(self.base_url)
+
     def get_slots_available(self):
         """Obtain the list of slots currently available in the system"""
         # Your code goes here
-        return self._send_request("GET", "/reservation/available")
+        return self._get("/reservation/available")
 
+    def get_slot_ids_available(self):
+        """Obtain the IDs of the slots currently available, as a compact
+        array decoded directly from the streamed response"""
+        return self._get("/reservation/available", slot_ids=True)
 
     def get_slots_held(self):
         """Obtain the list of slots currently held by the client"""
         # Your code goes here
-        return self._send_request("GET", "/reservation")
+        return self._get("/reservation")
 
 
     def release_slot(self, slot_id):
         """Release a slot currently held by the client"""
         # Your code goes here
         endpoint = f"/reservation/{slot_id}"
-        return self._send_request("DELETE", endpoint)
+        return self._write("DELETE", endpoint)
 
     def reserve_slot(self, slot_id):
         """Attempt to reserve a slot for the client"""
         # Your code goes here
         endpoint = f"/reservation/{slot_id}"
-        return self._send_request("POST", endpoint)
+        return self._write("POST", endpoint)
+
+    def _many(self, call, slot_ids, concurrency: int = None) -> dict:
+        """Call call(slot_id) for every slot ID with at most concurrency
+        (by default the pool size) requests in flight, returning each
+        slot's result or the exception it raised"""
+        slot_ids = list(slot_ids)
+        if not slot_ids:
+            return {}
+
+        def attempt(slot_id):
+            try:
+                return call(slot_id)
+            except Exception as e:
+                return e
+
+        workers = min(concurrency or self.pool_size, len(slot_ids))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            return dict(zip(slot_ids, pool.map(attempt, slot_ids)))
+
+    def reserve_many(self, slot_ids, concurrency: int = None) -> dict:
+        """Attempt to reserve every slot in slot_ids, pipelined within the
+        host's rate limit. Returns {slot_id: response or exception}, one
+        entry per slot; a failure does not stop the others."""
+        return self._many(self.reserve_slot, slot_ids, concurrency)
+
+    def release_many(self, slot_ids, concurrency: int = None) -> dict:
+        """Release every slot in slot_ids, pipelined within the host's
+        rate limit. Returns {slot_id: response or exception}, one entry
+        per slot; a failure does not stop the others."""
+        return self._many(self.release_slot, slot_ids, concurrency)
+
+    def get_state(self) -> dict:
+        """Fetch the held and available slots at the same time, returned
+        as {"held": [...], "available": [...]}"""
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            held = pool.submit(self.get_slots_held)
+            available = pool.submit(self.get_slots_available)
+            return {"held": held.result(), "available": available.result()}
+
+
+class AsyncReservationApi(_ClientBookkeeping):
+    def __init__(self, base_url: str, token: str, retries: int, delay: float,
+                 pool_size: int = 4, connect_timeout: float = 3.05,
+                 read_timeout: float = 10.0, rate: float = 1.0,
+                 backoff_max: float = 8.0, failure_threshold: int = 5,
+                 reset_timeout: float = 30.0, cache: ResponseCache = None,
+                 recorder: TrafficRecorder = None,
+                 replay: ReplayTransport = None, metrics: Metrics = None,
+                 timeouts: dict = None, deadline: float = None,
+                 hedge_percentile: float = None, headroom: float = 0.1):
+        """ Create a new AsyncReservationApi, the asyncio counterpart of
+        ReservationApi, with the same methods as coroutines.
+
+        The aiohttp session is created on first use so that it belongs to
+        the event loop the client is used from.
+
+        Args:
+            base_url: The URL of the reservation API to communicate with.
+            token: The user's API token obtained from the control panel.
+            retries: The maximum number of attempts to make for each request.
+            delay: The initial pause before retrying a failed request,
+                doubled on each further attempt.
+            pool_size: The number of keep-alive connections to keep open.
+            connect_timeout: Seconds to wait for a connection to be made.
+            read_timeout: Seconds to wait for the server to send a response.
+            rate: The requests per second allowed to this base URL, shared
+                with every other client of it using the same token.
+            backoff_max: The longest pause between retries, including any
+                Retry-After requested by the server.
+            failure_threshold: Consecutive failures after which requests to
+                this base URL fail fast with CircuitOpenError.
+            reset_timeout: Seconds to fail fast before probing the host again.
+            cache: A ResponseCache for GET requests, which may be shared
+                with other clients. Reads are not cached without one.
+            recorder: A TrafficRecorder to log every request attempt to.
+            replay: A ReplayTransport to answer requests from a recording
+                instead of the network.
+            metrics: A Metrics to report requests, retries and waits to.
+            timeouts: (connect, read) timeouts by endpoint ("/reservation",
+                "/reservation/available" or "/reservation/{id}"), for
+                endpoints that should not use connect_timeout and
+                read_timeout.
+            deadline: Seconds a whole request may take, retries, backoff
+                and rate-limit waits included, before DeadlineExceededError
+                is raised. None for no deadline.
+            hedge_percentile: Send a GET a second time once the first
+                attempt is slower than this percentile (e.g. 95) of recent
+                ones, if the rate limit has a request to spare. None to
+                never hedge.
+            headroom: The fraction of rate left unused, so that jitter
+                between sending and arrival does not break the server's
+                rate rule.
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncReservationApi requires aiohttp "
+                              "(pip install aiohttp)")
+        self.base_url  = base_url
+        self.token     = token
+        self.retries   = retries
+        self.delay     = delay
+        self.pool_size = pool_size
+        self.timeout   = (connect_timeout, read_timeout)
+        self.timeouts  = dict(timeouts or {})
+        self.deadline  = deadline
+        self.hedge_percentile = hedge_percentile
+        self.latencies = LatencyTracker()
+        self.backoff_max = backoff_max
+        self.limiter   = limiter_for(base_url, rate, token=token, headroom=headroom)
+        self.breaker   = breaker_for(base_url, failure_threshold, reset_timeout)
+        self.cache     = cache
+        self.recorder  = recorder
+        self.metrics   = metrics
+        self.replay    = replay
+        self._session  = None
+
+    async def _get_session(self):
+        """Return the aiohttp session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Accept": "application/json",
+                         "Authorization": "Bearer " + self.token})
+        return self._session
+
+    async def close(self):
+        """Close the connection pool"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @staticmethod
+    def _reason(status: int, body: bytes) -> str:
+        """Obtain the reason associated with a response"""
+        reason = message(body)
+        if reason is None:
+            try:
+                return HTTPStatus(status).phrase
+            except ValueError:
+                return ''
+        return reason
+
+    async def _attempt(self, method: str, url: str, timeout: tuple,
+                       slot_ids: bool = False):
+        """Make one request, returning (status, body, headers). With
+        slot_ids, a successful body is streamed into an array of slot IDs
+        as it arrives, unless a recorder needs the text."""
+        if self.replay is not None:
+            status, body, headers = await self.replay.respond_async(method, url)
+            return status, body.encode("utf-8"), headers
+        session = await self._get_session()
+        connect, read = timeout
+        async with session.request(method, url, timeout=aiohttp.ClientTimeout(
+                sock_connect=connect, sock_read=read)) as response:
+            if slot_ids and response.status == 200 and self.recorder is None:
+                scanner = SlotIdScanner()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    scanner.feed(chunk)
+                return response.status, scanner.finish(), response.headers
+            return response.status, await response.read(), response.headers
+
+    async def _request(self, method: str, url: str, endpoint: str, timeout: tuple,
+                       slot_ids: bool = False):
+        """Make one attempt. A read slower than usual is sent a second time
+        and whichever response arrives first is used."""
+        hedge_after = self._hedge_after(method, endpoint)
+        if hedge_after is None:
+            return await self._attempt(method, url, timeout, slot_ids)
+        first = asyncio.ensure_future(self._attempt(method, url, timeout, slot_ids))
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if done or not self.limiter.try_acquire():
+                return await first
+
+            self._hedged(endpoint)
+            pending.add(asyncio.ensure_future(self._attempt(method, url, timeout, slot_ids)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None:
+                    return winner.result()
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _send_request(self, method: str, endpoint: str,
+                            slot_ids: bool = False) -> dict:
+        """Send a request to the reservation API and convert errors to
+           appropriate exceptions. With slot_ids, the body of a successful
+           response is scanned into an array of slot IDs instead."""
+        url = self.base_url + endpoint
+        expires = self._expires()
+
+        for attempt in range(1, self.retries + 1):
+            self._remaining(expires, method, endpoint)
+            self.breaker.before_request()
+            with span("rate limit", host=self.base_url):
+                self._rate_waited(await self.limiter.acquire_async())
+            timeout = self._attempt_timeout(endpoint, self._remaining(expires, method, endpoint))
+            start = time.perf_counter()
+            try:
+                with span(f"attempt {attempt}", host=self.base_url) as attempt_span:
+                    status, body, headers = await self._request(method, url, endpoint, timeout,
+                                                                 slot_ids)
+                    attempt_span.set(outcome=status)
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    requests.ConnectionError) as e:
+                self._observe(method, endpoint, attempt, start, error=e)
+                self.breaker.record_failure()
+                warnings.warn(f"Request exception on try {attempt}/{self.retries}: {str(e)}")
+                with span("backoff", host=self.base_url):
+                    await asyncio.sleep(self._pause(self._retry_pause(attempt, endpoint),
+                                                    expires, method, endpoint))
+                continue
+
+            self._observe(method, endpoint, attempt, start, status, body, headers)
+
+            if 500 <= status < 600:
+                hint = retry_after(headers.get("Retry-After"))
+                if not throttled(status, hint):
+                    self.breaker.record_failure()
+                warnings.warn(f"Server error (try {attempt}/{self.retries}): {status} - {self._reason(status, body)}")
+                with span("backoff", host=self.base_url):
+                    await asyncio.sleep(self._pause(self._retry_pause(attempt, endpoint, hint),
+                                                    expires, method, endpoint))
+                continue
+
+            self.breaker.record_success()
+            if status == 200:
+                if not slot_ids:
+                    return loads(body)
+                # Already scanned unless it came from a replay or a recorder needed it
+                return slot_id_array(body) if isinstance(body, bytes) else body
+
+            elif status in STATUS_ERRORS:
+                raise STATUS_ERRORS[status](self._reason(status, body))
+            else:
+                raise HTTPError(f"{status} Error: {self._reason(status, body)} for url: {url}")
+
+        raise RetriesExceededError(f"Maximum retries exceeded, {method} {endpoint} failed.")
+
+    async def _get(self, endpoint: str, slot_ids: bool = False):
+        """Send a GET request, through the cache if there is one"""
+        with self._span("GET", endpoint):
+            if self.cache is None:
+                return await self._send_request("GET", endpoint, slot_ids)
+            return await self.cache.get_or_load_async(
+                self.base_url, self.token, endpoint,
+                lambda: self._send_request("GET", endpoint, slot_ids),
+                variant="ids" if slot_ids else "")
+
+    async def _write(self, method: str, endpoint: str):
+        """Send a request that changes reservations, invalidating cached
+        reads for this service whatever the outcome"""
+        try:
+            with self._span(method, endpoint):
+                return await self._send_request(method, endpoint)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(self.base_url)
+
+    async def get_slots_available(self):
+        """Obtain the list of slots currently available in the system"""
+        return await self._get("/reservation/available")
+
+    async def get_slot_ids_available(self):
+        """Obtain the IDs of the slots currently available, as a compact
+        array decoded directly from the response"""
+        return await self._get("/reservation/available", slot_ids=True)
+
+    async def get_slots_held(self):
+        """Obtain the list of slots currently held by the client"""
+        return await self._get("/reservation")
+
+    async def release_slot(self, slot_id):
+        """Release a slot currently held by the client"""
+        return await self._write("DELETE", f"/reservation/{slot_id}")
+
+    async def reserve_slot(self, slot_id):
+        """Attempt to reserve a slot for the client"""
+        return await self._write("POST", f"/reservation/{slot_id}")
+
+    async def _many(self, call, slot_ids, concurrency: int = None) -> dict:
+        """Await call(slot_id) for every slot ID with at most concurrency
+        (by default the pool size) requests in flight, returning each
+        slot's result or the exception it raised"""
+        slot_ids = list(slot_ids)
+        semaphore = asyncio.Semaphore(concurrency or self.pool_size)
+
+        async def attempt(slot_id):
+            async with semaphore:
+                return await call(slot_id)
+
+        results = await asyncio.gather(*(attempt(slot_id) for slot_id in slot_ids),
+                                       return_exceptions=True)
+        return dict(zip(slot_ids, results))
+
+    async def reserve_many(self, slot_ids, concurrency: int = None) -> dict:
+        """Attempt to reserve every slot in slot_ids, pipelined within the
+        host's rate limit. Returns {slot_id: response or exception}, one
+        entry per slot; a failure does not stop the others."""
+        return await self._many(self.reserve_slot, slot_ids, concurrency)
+
+    async def release_many(self, slot_ids, concurrency: int = None) -> dict:
+        """Release every slot in slot_ids, pipelined within the host's
+        rate limit. Returns {slot_id: response or exception}, one entry
+        per slot; a failure does not stop the others."""
+        return await self._many(self.release_slot, slot_ids, concurrency)
+
+    async def get_state(self) -> dict:
+        """Fetch the held and available slots at the same time, returned
+        as {"held": [...], "available": [...]}"""
+        held, available = await asyncio.gather(self.get_slots_held(),
+                                               self.get_slots_available())
+        return {"held": held, "available": available}
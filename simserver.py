@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+""" Simulated reservation server
+
+A local stand-in for the hotel and band reservation servers, for offline
+testing and load experiments. It implements the same contract:
+
+    GET    /{provider}/api/reservation/available   slots free to reserve
+    GET    /{provider}/api/reservation             slots held by the client
+    POST   /{provider}/api/reservation/{id}        reserve a slot
+    DELETE /{provider}/api/reservation/{id}        release a slot
+
+with the same error statuses (400 malformed slot ID, 401 bad token, 403
+no such slot, 404 not processed, 409 slot unavailable, 451 reservation
+limit reached, 5xx server errors). Latency, injected errors, per-token
+limits, rate-limit enforcement and competing clients that take slots are
+all configurable. Point a client at it by changing the url in api.ini,
+e.g. url = http://127.0.0.1:8000/hotel/api
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROUTE = re.compile(r"^/(?P<provider>[^/]+)/api/reservation"
+                   r"(?:/(?P<slot>available|[^/]+))?/?$")
+
+
+def parse_latency(spec: str):
+    """Build a function returning a latency in seconds from a spec such as
+    "fixed:0.05", "uniform:0.02,0.2", "exp:0.05" (mean) or
+    "lognormal:0.05,0.5" (median, sigma)"""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0] if values else 0.0
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class Provider:
+    """The reservation state of one simulated service"""
+
+    def __init__(self, name: str, slots: int):
+        self.name  = name
+        self.slots = slots
+        self.holds = {}
+        self.lock  = threading.Lock()
+
+    def available(self) -> list:
+        with self.lock:
+            return [{"id": slot} for slot in range(1, self.slots + 1)
+                    if slot not in self.holds]
+
+    def held(self, token: str) -> list:
+        with self.lock:
+            return [{"id": slot} for slot, owner in sorted(self.holds.items())
+                    if owner == token]
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    """Drops connections closed by the client without a traceback, e.g. a
+    hedged read's loser or a request given up on by its timeout"""
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class SimulatedServer:
+    def __init__(self, providers=("hotel", "band"), slots: int = 200,
+                 max_holds: int = 2, latency: str = "fixed:0",
+                 error_rate: float = 0.0, rate: float = 0.0, tokens=None,
+                 competitors: int = 0, competitor_interval: float = 1.0,
+                 host: str = "127.0.0.1", port: int = 8000, seed=None):
+        """ Create a simulated server (call start() to serve).
+
+        Args:
+            providers: The names of the services to simulate.
+            slots: The number of slots each service offers, numbered from 1.
+            max_holds: The most slots one token may hold with a service.
+            latency: The distribution of response latency, see
+                parse_latency.
+            error_rate: The fraction of requests answered with a 5xx error.
+            rate: The requests per second each token may send to each
+                service, or 0 for no limit. Faster requests get a 503.
+            tokens: The valid API tokens, or None to accept any token.
+            competitors: The number of simulated clients taking slots.
+            competitor_interval: Mean seconds between competitor actions.
+            host: The address to listen on.
+            port: The port to listen on, or 0 for any free port.
+            seed: Seed for the random number generator.
+        """
+        if seed is not None:
+            random.seed(seed)
+        self.providers  = {name: Provider(name, slots) for name in providers}
+        self.max_holds  = max_holds
+        self.latency    = parse_latency(latency)
+        self.error_rate = error_rate
+        self.rate       = rate
+        self.tokens     = set(tokens) if tokens else None
+        self.competitors = competitors
+        self.competitor_interval = competitor_interval
+        self.requests   = 0
+        self._last_seen = {}
+        self._lock      = threading.Lock()
+        self._stopped   = threading.Event()
+        self._httpd     = _QuietHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def url(self, provider: str) -> str:
+        """The base URL to configure for a provider"""
+        host = self._httpd.server_address[0]
+        return f"http://{host}:{self.port}/{provider}/api"
+
+    def start(self):
+        """Serve in background threads"""
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        for n in range(self.competitors):
+            threading.Thread(target=self._compete, args=(f"competitor-{n}",),
+                             daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        self.start()
+        self._stopped.wait()
+
+    def reset(self):
+        """Release every hold and forget rate-limit history"""
+        for provider in self.providers.values():
+            with provider.lock:
+                provider.holds.clear()
+        with self._lock:
+            self._last_seen.clear()
+
+    def _too_fast(self, provider: str, token: str) -> bool:
+        """Record a request and report whether it broke the rate limit"""
+        if not self.rate:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_seen.get((provider, token))
+            if last is not None and now - last < 1 / self.rate:
+                return True
+            self._last_seen[(provider, token)] = now
+            return False
+
+    def handle(self, method: str, path: str, auth: str):
+        """Process a request, returning (status, body, headers)"""
+        with self._lock:
+            self.requests += 1
+        match = ROUTE.match(path.split("?", 1)[0])
+        if match is None or match["provider"] not in self.providers:
+            return 404, {"message": "Not found"}, {}
+        provider = self.providers[match["provider"]]
+        slot = match["slot"]
+
+        token = auth[7:].strip() if auth and auth.startswith("Bearer ") else ""
+        if not token or (self.tokens is not None and token not in self.tokens):
+            return 401, {"message": "Invalid or missing API token"}, {}
+
+        if self._too_fast(provider.name, token):
+            return 503, {"message": "Too many requests"}, {"Retry-After": str(1 / self.rate)}
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                # A "real" server error with no JSON message in the body
+                return 500, None, {}
+            return 503, {"message": "Service temporarily unavailable"}, {}
+
+        if method == "GET" and slot is None:
+            return 200, provider.held(token), {}
+        if method == "GET" and slot == "available":
+            return 200, provider.available(), {}
+        if method not in ("POST", "DELETE") or slot is None:
+            return 404, {"message": "Not found"}, {}
+
+        try:
+            slot_id = int(slot)
+        except ValueError:
+            return 400, {"message": f"Invalid slot ID: {slot}"}, {}
+        if not 1 <= slot_id <= provider.slots:
+            return 403, {"message": f"Slot {slot_id} does not exist"}, {}
+
+        with provider.lock:
+            owner = provider.holds.get(slot_id)
+            if method == "POST":
+                if owner is not None:
+                    return 409, {"message": f"Slot {slot_id} is not available"}, {}
+                held = sum(1 for o in provider.holds.values() if o == token)
+                if held >= self.max_holds:
+                    return 451, {"message": f"Reservation limit of {self.max_holds} reached"}, {}
+                provider.holds[slot_id] = token
+                return 200, {"id": slot_id}, {}
+            if owner != token:
+                return 404, {"message": f"Slot {slot_id} is not held by this client"}, {}
+            del provider.holds[slot_id]
+            return 200, {"id": slot_id}, {}
+
+    def _compete(self, token: str):
+        """Act as another client, grabbing early slots and letting them go"""
+        while not self._stopped.wait(random.expovariate(1 / self.competitor_interval)):
+            provider = random.choice(list(self.providers.values()))
+            with provider.lock:
+                mine = [slot for slot, owner in provider.holds.items() if owner == token]
+                if len(mine) < self.max_holds and random.random() < 0.6:
+                    free = [slot for slot in range(1, provider.slots + 1)
+                            if slot not in provider.holds][:10]
+                    if free:
+                        provider.holds[random.choice(free)] = token
+                elif mine:
+                    del provider.holds[random.choice(mine)]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately; without this the
+            # body waits for a delayed ACK on keep-alive connections
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self):
+                status, body, headers = server.handle(
+                    self.command, self.path, self.headers.get("Authorization"))
+                time.sleep(max(0.0, server.latency()))
+                payload = b"" if body is None else json.dumps(body).encode()
+                self.send_response(status)
+                if body is not None:
+                    self.send_header("Content-Type", "application/json")
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_DELETE = _respond
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated reservation server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--providers", nargs="+", default=["hotel", "band"])
+    parser.add_argument("--slots", type=int, default=200)
+    parser.add_argument("--max-holds", type=int, default=2)
+    parser.add_argument("--latency", default="fixed:0.05",
+                        help="fixed:S, uniform:A,B, exp:MEAN or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="requests per second per token and service (0 = unlimited)")
+    parser.add_argument("--tokens", nargs="*", help="valid API tokens (default: any)")
+    parser.add_argument("--competitors", type=int, default=0)
+    parser.add_argument("--competitor-interval", type=float, default=1.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    server = SimulatedServer(
+        args.providers, args.slots, args.max_holds, args.latency,
+        args.error_rate, args.rate, args.tokens, args.competitors,
+        args.competitor_interval, args.host, args.port, args.seed)
+    for name in args.providers:
+        print(f"[{name}] url = {server.url(name)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+""" On-disk snapshots of reservation state
+
+This module implements the store booking.py uses to start instantly: the
+last held and available slots fetched from each service are kept in a
+SQLite database with the time they were fetched, so the next launch can
+show them straight away (marked as stale) while fresh data is fetched in
+the background. Snapshots are keyed by base URL and a SHA-256 hash of the
+API token, so two accounts on one service never see each other's slots;
+the tokens themselves are never written to disk.
+
+Saves are queued and written by a background thread, so saving never
+blocks the caller (or the event loop it runs on) on serialising or disk
+I/O, and a failed write is only counted, never raised: a snapshot is a
+convenience and must not fail a booking.
+"""
+
+import hashlib
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+HELD      = "held"
+AVAILABLE = "available"
+
+# Bumped whenever the table changes; older snapshots are simply dropped
+_SCHEMA = 1
+
+
+def account(token: str) -> str:
+    """The key a token's snapshots are saved under"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class SnapshotStore:
+    def __init__(self, path: str):
+        """ Open (or create) a snapshot database.
+
+        Args:
+            path: The SQLite file to keep snapshots in.
+        """
+        self.path       = path
+        self.errors     = 0
+        self.last_error = None
+        self._lock      = threading.Lock()
+        self._queue     = queue.SimpleQueue()
+        self._closed    = False
+        self._db        = sqlite3.connect(path, check_same_thread=False,
+                                          isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA:
+            self._db.execute("DROP TABLE IF EXISTS snapshots")
+            self._db.execute(f"PRAGMA user_version = {_SCHEMA}")
+        self._db.execute("CREATE TABLE IF NOT EXISTS snapshots ("
+                         "base_url TEXT, account TEXT, kind TEXT, fetched REAL, "
+                         "data TEXT, PRIMARY KEY (base_url, account, kind))")
+        self._writer    = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    def save(self, base_url: str, token: str, kind: str, data,
+             fetched: float = None):
+        """Queue the snapshot of kind (HELD or AVAILABLE) for a service and
+        token to replace the saved one"""
+        if not self._closed:
+            self._queue.put((base_url.rstrip("/"), account(token), kind,
+                             time.time() if fetched is None else fetched, data))
+
+    def _write(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            if isinstance(entry, threading.Event):
+                entry.set()
+                continue
+            base_url, key, kind, fetched, data = entry
+            try:
+                with self._lock:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)",
+                        (base_url, key, kind, fetched, json.dumps(data)))
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                self.errors += 1
+                self.last_error = e
+
+    def load(self, base_url: str, token: str, kind: str):
+        """Return (fetched, data) for the last snapshot of kind saved for a
+        service and token, where fetched is a Unix timestamp, or None if
+        there is none"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fetched, data FROM snapshots "
+                "WHERE base_url = ? AND account = ? AND kind = ?",
+                (base_url.rstrip("/"), account(token), kind)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def flush(self):
+        """Wait until every queued snapshot has been written"""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        """Write everything still queued and close the database"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._writer.join()
+            with self._lock:
+                self._db.close()
+
+
+def age(fetched: float) -> str:
+    """How long ago a Unix timestamp was, roughly, e.g. '5m'"""
+    seconds = max(0, time.time() - fetched)
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size:
+            return f"{seconds // size:.0f}{unit}"
+    return f"{seconds:.0f}s"
@@ -0,0 +1,88 @@
+import asyncio
+import configparser
+import io
+import json
+
+import pytest
+
+from batch import BatchRunner, read_jobs
+from daemon import BookingDaemon
+from simserver import SimulatedServer
+
+
+def make_config(server, **settings):
+    config = configparser.ConfigParser()
+    for name in server.providers:
+        config[name] = {"url": server.url(name), "key": "default"}
+    config["global"] = {"retries": "3", "delay": "0.05", "ttl_available": "0",
+                        "ttl_held": "0", **settings}
+    return config
+
+
+@pytest.fixture
+def server():
+    server = SimulatedServer(rate=5, port=0, seed=1).start()
+    yield server
+    server.stop()
+
+
+def run_jobs(runner, jobs):
+    out = io.StringIO()
+    asyncio.run(runner.run(enumerate(jobs, 1), out))
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_throttling_one_token_does_not_trip_the_breaker_for_others(server):
+    # The clients send twice as fast as the server allows, so every token
+    # is throttled (503 with Retry-After) many times over
+    config = make_config(server, rate="10", rate_headroom="0", retries="10",
+                         failure_threshold="5")
+    # Distinct slots, so any failure comes from throttling, not contention
+    jobs = [{"id": n, "action": "reserve-specific", "slot": n + 1,
+             "tokens": {"hotel": f"user-{n % 7}", "band": f"user-{n % 7}"}}
+            for n in range(12)]
+    results = run_jobs(BatchRunner(config, workers=8), jobs)
+    assert len(results) == 12
+    assert all(r["ok"] for r in results), [r["error"] for r in results if not r["ok"]]
+
+
+def test_slot_ids_given_as_strings_are_accepted(server):
+    # Sent at about the server's limit, so the odd request may be throttled
+    config = make_config(server, rate="5", retries="10", upgrade_min_interval="0.1")
+    jobs = [{"id": "book", "action": "reserve-specific", "slot": "30"},
+            {"id": "upgrade", "action": "upgrade-until", "slot": "30",
+             "target": "1", "timeout": "5", "constraints": {"after": "10"}}]
+    runner = BatchRunner(config, workers=1)
+    results = {r["id"]: r for r in run_jobs(runner, jobs)}
+    assert results["book"]["ok"] and results["book"]["slot"] == 30
+    assert results["upgrade"]["ok"], results["upgrade"]
+    assert results["upgrade"]["slot"] == 10
+
+
+@pytest.mark.parametrize("job", [
+    {"action": "reserve-specific", "slot": "thirty"},
+    {"action": "reserve-specific"},
+    {"action": "upgrade-until", "slot": 30, "target": [1]},
+    {"action": "upgrade-until", "slot": 30, "timeout": "soon"},
+    {"action": "reserve-earliest", "constraints": {"exclude": "42"}},
+    [1, 2],
+    "x",
+    5,
+])
+def test_malformed_jobs_fail_without_requests(server, job):
+    out = io.StringIO()
+    asyncio.run(BatchRunner(make_config(server)).run(read_jobs([json.dumps(job)]), out))
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert results[0]["error"].startswith("JobInputError")
+    assert server.requests == 0
+
+
+def test_daemon_rejects_malformed_slot_with_400(server):
+    daemon = BookingDaemon(make_config(server)).start()
+    try:
+        status, body = daemon.handle("POST", "/upgrade", b'{"slot": "x"}')
+        assert status == 400, body
+        status, body = daemon.handle("GET", "/matching?limit=2&after=5", b"")
+        assert (status, body) == (200, [5, 6])
+    finally:
+        daemon.stop()
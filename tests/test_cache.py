@@ -0,0 +1,195 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from cache import ResponseCache
+
+URL = "http://example.test/hotel/api"
+HELD = "/reservation"
+
+
+def test_hit_until_ttl_expires():
+    cache = ResponseCache(ttls={HELD: 0.05})
+    calls = []
+
+    def load():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.get_or_load(URL, "t", HELD, load) == 1
+    assert cache.get_or_load(URL, "t", HELD, load) == 1
+    time.sleep(0.06)
+    assert cache.get_or_load(URL, "t", HELD, load) == 2
+    assert cache.stats()["hits"] == 1
+
+
+def test_least_recently_used_is_evicted():
+    cache = ResponseCache(maxsize=2, default_ttl=60)
+    for endpoint in ("/a", "/b"):
+        cache.get_or_load(URL, "t", endpoint, lambda: endpoint)
+    cache.get_or_load(URL, "t", "/a", lambda: "reloaded")
+    cache.get_or_load(URL, "t", "/c", lambda: "c")
+    assert cache.get_or_load(URL, "t", "/a", lambda: "reloaded") == "/a"
+    assert cache.get_or_load(URL, "t", "/b", lambda: "reloaded") == "reloaded"
+    assert cache.evictions == 2
+
+
+def test_invalidate_during_load_discards_result():
+    cache = ResponseCache(default_ttl=60)
+
+    def load():
+        cache.invalidate(URL)
+        return "stale"
+
+    assert cache.get_or_load(URL, "t", HELD, load) == "stale"
+    assert cache.get_or_load(URL, "t", HELD, lambda: "fresh") == "fresh"
+
+
+def test_concurrent_sync_loads_are_coalesced():
+    cache = ResponseCache(default_ttl=0)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "value"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        cache.get_or_load(URL, "t", HELD, load))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while cache.coalesced < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ["value"] * 5
+    assert len(calls) == 1
+
+
+def test_sync_waiters_share_loader_exception():
+    cache = ResponseCache(default_ttl=0)
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("boom")
+
+    errors = []
+
+    def call(loader):
+        try:
+            cache.get_or_load(URL, "t", HELD, loader)
+        except ValueError as e:
+            errors.append(e)
+
+    loader = threading.Thread(target=call, args=(fail,))
+    loader.start()
+    started.wait(5)
+    waiter = threading.Thread(target=call, args=(lambda: "unused",))
+    waiter.start()
+    while cache.coalesced < 1:
+        time.sleep(0.001)
+    release.set()
+    loader.join(5)
+    waiter.join(5)
+    assert len(errors) == 2
+
+
+def test_interrupted_sync_load_does_not_strand_the_key():
+    cache = ResponseCache(default_ttl=0)
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        cache.get_or_load(URL, "t", HELD, interrupted)
+
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(cache.get_or_load(URL, "t", HELD, lambda: "value")),
+        daemon=True)
+    thread.start()
+    thread.join(2)
+    assert result == ["value"]
+
+
+def test_sync_waiter_retries_after_interrupted_load():
+    cache = ResponseCache(default_ttl=0)
+    started = threading.Event()
+    release = threading.Event()
+
+    def interrupted():
+        started.set()
+        release.wait(5)
+        raise KeyboardInterrupt
+
+    def loader():
+        with pytest.raises(KeyboardInterrupt):
+            cache.get_or_load(URL, "t", HELD, interrupted)
+
+    result = []
+    first = threading.Thread(target=loader)
+    first.start()
+    started.wait(5)
+    waiter = threading.Thread(
+        target=lambda: result.append(cache.get_or_load(URL, "t", HELD, lambda: "value")),
+        daemon=True)
+    waiter.start()
+    while cache.coalesced < 1:
+        time.sleep(0.001)
+    release.set()
+    first.join(5)
+    waiter.join(5)
+    assert result == ["value"]
+
+
+def test_async_loads_are_coalesced():
+    cache = ResponseCache(default_ttl=0)
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def main():
+        return await asyncio.gather(
+            *(cache.get_or_load_async(URL, "t", HELD, load) for _ in range(5)))
+
+    assert asyncio.run(main()) == ["value"] * 5
+    assert len(calls) == 1
+
+
+def test_cancelling_the_loader_does_not_cancel_waiters():
+    cache = ResponseCache(default_ttl=0)
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "value"
+
+    async def main():
+        a = asyncio.ensure_future(cache.get_or_load_async(URL, "t", HELD, load))
+        await asyncio.sleep(0)
+        b = asyncio.ensure_future(cache.get_or_load_async(URL, "t", HELD, load))
+        await asyncio.sleep(0.01)
+        a.cancel()
+        await asyncio.gather(a, return_exceptions=True)
+        return a, await b
+
+    a, value = asyncio.run(main())
+    assert a.cancelled()
+    assert value == "value"
+    assert len(calls) == 2
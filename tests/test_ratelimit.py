@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import pytest
+
+from ratelimit import TokenBucket
+from reservationapi import AsyncReservationApi, ReservationApi
+from simserver import SimulatedServer
+
+
+def test_requests_are_spaced_below_the_rate():
+    bucket = TokenBucket(50, headroom=0.1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 5 / 45 - 0.005
+    assert bucket.waits == 5
+
+
+def test_try_acquire_never_waits():
+    bucket = TokenBucket(1)
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert bucket.waits == 0
+
+
+@pytest.fixture
+def server():
+    server = SimulatedServer(rate=5, port=0, latency="fixed:0.01").start()
+    yield server
+    server.stop()
+
+
+def test_sequential_requests_are_never_throttled(server):
+    with ReservationApi(server.url("hotel"), "sequential", 3, 0.01, rate=5) as api:
+        for _ in range(20):
+            api.get_slots_held()
+    assert server.requests == 20
+
+
+def test_concurrent_requests_are_never_throttled(server):
+    async def main():
+        async with AsyncReservationApi(server.url("hotel"), "concurrent", 3, 0.01,
+                                       rate=5) as api:
+            await asyncio.gather(*(api.get_slots_held() for _ in range(20)))
+
+    asyncio.run(main())
+    assert server.requests == 20
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from reconciler import Reconciler
+from reservationapi import AsyncReservationApi
+from simserver import SimulatedServer
+
+
+@pytest.fixture
+def server():
+    server = SimulatedServer(port=0, slots=50).start()
+    yield server
+    server.stop()
+
+
+def hold(server, provider, *slot_ids, token="me"):
+    with server.providers[provider].lock:
+        for slot_id in slot_ids:
+            server.providers[provider].holds[slot_id] = token
+
+
+def held(server, provider, token="me"):
+    return sorted(slot for slot, owner in server.providers[provider].holds.items()
+                  if owner == token)
+
+
+def reconcile(server, owed, intended=(), busy=()):
+    """Run one pass over the owed (name, slot) pairs, returning what was
+    reclaimed and what is still owed"""
+    async def main():
+        services = [(name, AsyncReservationApi(server.url(name), "me", 3, 0.01, rate=100))
+                    for name in ("hotel", "band")]
+        reconciler = Reconciler(services, lambda: list(intended))
+        for name, slot_id in owed:
+            reconciler.owe(name, slot_id)
+        try:
+            with reconciler.protect(*busy):
+                return await reconciler.reconcile(), reconciler.owed
+        finally:
+            for _, api in services:
+                await api.close()
+    return asyncio.run(main())
+
+
+def test_partial_hold_released(server):
+    hold(server, "hotel", 5)
+    reclaimed, owed = reconcile(server, [("hotel", 5)])
+    assert reclaimed == [("hotel", 5)]
+    assert held(server, "hotel") == [] and not owed
+
+
+def test_complete_booking_kept(server):
+    hold(server, "hotel", 5)
+    hold(server, "band", 5)
+    reclaimed, owed = reconcile(server, [("hotel", 5)])
+    assert reclaimed == []
+    assert held(server, "hotel") == [5] and held(server, "band") == [5]
+    assert not owed
+
+
+def test_protected_and_intended_slots_kept(server):
+    hold(server, "hotel", 5, 6)
+    reclaimed, owed = reconcile(server, [("hotel", 5), ("hotel", 6)],
+                                intended=[5], busy=[6])
+    assert reclaimed == []
+    assert held(server, "hotel") == [5, 6]
+    # Still owed, to be released once no longer protected
+    assert owed == {("hotel", "5"), ("hotel", "6")}
+
+
+def test_unrecorded_partial_holds_left_alone(server):
+    # e.g. booked before a [caterer] section was added, or by batch.py
+    hold(server, "hotel", 7)
+    hold(server, "band", 8)
+    before = server.requests
+    reclaimed, _ = reconcile(server, [])
+    assert reclaimed == []
+    assert held(server, "hotel") == [7] and held(server, "band") == [8]
+    assert server.requests == before
+
+
+def test_hold_released_elsewhere_is_forgotten(server):
+    reclaimed, owed = reconcile(server, [("band", 9)])
+    assert reclaimed == [] and not owed
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from recorder import ReplayTransport, TrafficRecorder
+from reservationapi import AsyncReservationApi, ReservationApi
+from simserver import SimulatedServer
+
+
+@pytest.fixture
+def recording(tmp_path):
+    """A recording of a reservation, then the held and available slots"""
+    server = SimulatedServer(port=0, slots=20).start()
+    path = tmp_path / "traffic.jsonl"
+    recorder = TrafficRecorder(str(path))
+    with ReservationApi(server.url("hotel"), "token", 3, 0.01, rate=100,
+                        recorder=recorder) as api:
+        api.reserve_slot(3)
+        api.get_slots_held()
+        api.get_slots_available()
+    recorder.close()
+    server.stop()
+    return server.url("hotel"), str(path)
+
+
+def test_replay_serves_slot_ids_streamed(recording):
+    url, path = recording
+    with ReservationApi(url, "token", 3, 0.01, rate=100,
+                        replay=ReplayTransport(path, speed=0, loop=True)) as api:
+        assert api.get_slots_held() == [{"id": 3}]
+        ids = api.get_slot_ids_available()
+        assert list(ids) == [slot for slot in range(1, 21) if slot != 3]
+        assert api.get_slots_available() == [{"id": slot} for slot in ids]
+
+
+def test_async_replay_serves_slot_ids(recording):
+    url, path = recording
+
+    async def replay():
+        async with AsyncReservationApi(url, "token", 3, 0.01, rate=100,
+                                       replay=ReplayTransport(path, speed=0)) as api:
+            return list(await api.get_slot_ids_available())
+
+    assert asyncio.run(replay()) == [slot for slot in range(1, 21) if slot != 3]
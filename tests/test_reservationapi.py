@@ -0,0 +1,97 @@
+import asyncio
+import json
+import time
+from array import array
+
+import pytest
+
+from decoding import SlotIdScanner
+from exceptions import DeadlineExceededError
+from metrics import Metrics
+from reservationapi import AsyncReservationApi, ReservationApi, shared_session
+from simserver import SimulatedServer
+
+
+def test_services_on_one_host_share_a_pool_sized_for_the_largest():
+    hotel = ReservationApi("http://shared.test:8000/hotel/api", "t", 3, 0.1,
+                           pool_size=2, share_pool=True)
+    band = ReservationApi("http://shared.test:8000/band/api", "t", 3, 0.1,
+                          pool_size=6, share_pool=True)
+    other = ReservationApi("http://shared.test:8001/band/api", "t", 3, 0.1,
+                           pool_size=2, share_pool=True)
+    assert hotel.session is band.session
+    assert other.session is not hotel.session
+    assert hotel.session.get_adapter("http://shared.test:8000/")._pool_maxsize == 6
+    assert shared_session("http://shared.test:8000/x", pool_size=3) is hotel.session
+    assert hotel.session.get_adapter("http://shared.test:8000/")._pool_maxsize == 6
+
+
+def test_slot_ids_split_across_chunks_are_scanned_whole():
+    body = json.dumps([{"id": slot} for slot in range(1, 300)]).encode()
+    scanner = SlotIdScanner()
+    for i in range(0, len(body), 7):
+        scanner.feed(body[i:i + 7])
+    assert scanner.finish().tolist() == list(range(1, 300))
+
+
+def test_async_client_streams_slot_ids():
+    server = SimulatedServer(port=0, slots=20000).start()
+
+    async def fetch():
+        api = AsyncReservationApi(server.url("hotel"), "t", 1, 0.1, rate=100)
+        try:
+            return await api.get_slot_ids_available()
+        finally:
+            await api.close()
+
+    try:
+        ids = asyncio.run(fetch())
+    finally:
+        server.stop()
+    assert isinstance(ids, array)
+    assert ids.tolist() == list(range(1, 20001))
+
+
+def test_deadline_bounds_retries_against_a_failing_server():
+    server = SimulatedServer(port=0, error_rate=1.0).start()
+
+    async def fetch():
+        api = AsyncReservationApi(server.url("hotel"), "t", 100, 0.1, rate=100,
+                                  backoff_max=0.1, failure_threshold=1000,
+                                  deadline=1.0)
+        try:
+            with pytest.raises(DeadlineExceededError):
+                await api.get_slots_available()
+            return api
+        finally:
+            await api.close()
+
+    start = time.monotonic()
+    try:
+        with pytest.warns(UserWarning):
+            api = asyncio.run(fetch())
+    finally:
+        server.stop()
+    assert 0.8 <= time.monotonic() - start < 1.5
+    assert not api.latencies._samples
+
+
+def test_slow_reads_are_hedged():
+    server = SimulatedServer(port=0, latency="lognormal:0.01,1.0", seed=1).start()
+    metrics = Metrics()
+
+    async def fetch():
+        api = AsyncReservationApi(server.url("hotel"), "t", 1, 0.1, rate=1000,
+                                  metrics=metrics, hedge_percentile=80)
+        try:
+            for _ in range(60):
+                await api.get_slots_available()
+        finally:
+            await api.close()
+
+    try:
+        asyncio.run(fetch())
+    finally:
+        server.stop()
+    endpoints = next(iter(metrics.snapshot().values()))["endpoints"]
+    assert sum(endpoint["hedges"] for endpoint in endpoints.values()) > 0
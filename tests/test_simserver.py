@@ -0,0 +1,21 @@
+import socket
+import struct
+import time
+
+from simserver import SimulatedServer
+
+
+def test_connections_reset_by_the_client_are_dropped_quietly(capfd):
+    server = SimulatedServer(port=0, latency="fixed:0.1").start()
+    try:
+        for _ in range(3):
+            client = socket.create_connection(("127.0.0.1", server.port))
+            # Close with a reset rather than a FIN while the response is pending
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            client.sendall(b"GET /hotel/api/reservation/available HTTP/1.1\r\n"
+                           b"Host: localhost\r\nAuthorization: Bearer t\r\n\r\n")
+            client.close()
+        time.sleep(0.3)
+    finally:
+        server.stop()
+    assert "Traceback" not in capfd.readouterr().err
@@ -0,0 +1,49 @@
+from snapshot import AVAILABLE, HELD, SnapshotStore
+
+URL = "http://example.test/hotel/api"
+
+
+def test_saved_snapshot_is_loaded(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshot.db"))
+    store.save(URL + "/", "t", HELD, [{"id": 3}], fetched=100.0)
+    store.flush()
+    assert store.load(URL, "t", HELD) == (100.0, [{"id": 3}])
+    assert store.load(URL, "t", AVAILABLE) is None
+    store.close()
+
+
+def test_close_writes_everything_queued(tmp_path):
+    path = str(tmp_path / "snapshot.db")
+    store = SnapshotStore(path)
+    for n in range(50):
+        store.save(URL, "t", AVAILABLE, list(range(n)), fetched=n)
+    store.close()
+    store = SnapshotStore(path)
+    assert store.load(URL, "t", AVAILABLE) == (49, list(range(49)))
+    store.close()
+
+
+def test_failed_write_is_counted_not_raised(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshot.db"))
+    store.save(URL, "t", HELD, {object()})
+    store.save(URL, "t", AVAILABLE, [1, 2])
+    store.flush()
+    assert store.errors == 1
+    assert store.load(URL, "t", HELD) is None
+    assert store.load(URL, "t", AVAILABLE)[1] == [1, 2]
+    store.close()
+    store.save(URL, "t", HELD, [])
+
+
+def test_snapshots_are_kept_per_token(tmp_path):
+    path = str(tmp_path / "snapshot.db")
+    store = SnapshotStore(path)
+    store.save(URL, "alice", HELD, [1])
+    store.save(URL, "bob", HELD, [2])
+    store.close()
+    assert b"alice" not in (tmp_path / "snapshot.db").read_bytes()
+    store = SnapshotStore(path)
+    assert store.load(URL, "alice", HELD)[1] == [1]
+    assert store.load(URL, "bob", HELD)[1] == [2]
+    assert store.load(URL, "carol", HELD) is None
+    store.close()
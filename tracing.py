@@ -0,0 +1,175 @@
+""" Phase-level tracing
+
+Spans record how long each phase of a booking took, nested under the
+phase that started them: fetching availability, matching, reserving,
+rolling back, each request and each attempt at it. The current span is
+kept in a context variable, so spans started inside asyncio tasks nest
+under the span that was current when the task was created.
+
+Tracing is off until enable() is called; until then span() returns a
+shared no-op span. write() saves everything recorded in the Chrome
+trace-event format, which chrome://tracing and ui.perfetto.dev show as a
+flame view. Spans that overlap without nesting (e.g. requests sent to
+every service at once) are put on separate lanes so each stays readable.
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+
+_current = contextvars.ContextVar("tracing_span", default=None)
+_tracer = None
+
+
+class Span:
+    """A timed phase with attributes such as host, slot and outcome"""
+
+    __slots__ = ("tracer", "name", "attrs", "parent", "lane", "start", "_token")
+
+    def __init__(self, tracer, name: str, attrs: dict):
+        self.tracer = tracer
+        self.name   = name
+        self.attrs  = attrs
+        self.parent = None
+        self.lane   = None
+        self.start  = None
+        self._token = None
+
+    def set(self, **attrs):
+        """Add or replace attributes, e.g. the outcome once it is known"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.parent = _current.get()
+        self.start  = time.perf_counter()
+        self.tracer._open(self)
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None and "outcome" not in self.attrs:
+            self.attrs["outcome"] = exc_type.__name__
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # Exited in a different context from the one it was entered in
+            _current.set(self.parent)
+        self.tracer._close(self, end)
+        return False
+
+
+class _NoSpan:
+    """Stands in for Span while tracing is off"""
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Tracer:
+    def __init__(self):
+        self.events = []
+        self._start = time.perf_counter()
+        self._lanes = []
+        self._lock  = threading.Lock()
+
+    def _open(self, span: Span):
+        """Put span on its parent's lane if nothing else is open above the
+        parent there, otherwise on the first free lane"""
+        with self._lock:
+            parent = span.parent
+            if parent is not None and parent.lane is not None \
+                    and self._lanes[parent.lane] and self._lanes[parent.lane][-1] is parent:
+                lane = parent.lane
+            else:
+                lane = next((i for i, stack in enumerate(self._lanes) if not stack), None)
+                if lane is None:
+                    lane = len(self._lanes)
+                    self._lanes.append([])
+            span.lane = lane
+            self._lanes[lane].append(span)
+
+    def _close(self, span: Span, end: float):
+        with self._lock:
+            self._lanes[span.lane].remove(span)
+            self.events.append({
+                "name": span.name, "ph": "X", "pid": os.getpid(),
+                "tid": span.lane,
+                "ts": round((span.start - self._start) * 1e6, 3),
+                "dur": round((end - span.start) * 1e6, 3),
+                "args": {key: value if isinstance(value, (int, float, bool)) or value is None
+                         else str(value) for key, value in span.attrs.items()
+                         if value is not None},
+            })
+
+    def span(self, name: str, **attrs) -> Span:
+        return Span(self, name, attrs)
+
+    def to_chrome(self) -> dict:
+        """Everything recorded, as a Chrome trace-event document"""
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+            lanes = len(self._lanes)
+        names = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": lane,
+                  "args": {"name": f"lane {lane}"}} for lane in range(lanes)]
+        return {"traceEvents": names + events, "displayTimeUnit": "ms"}
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome(), f)
+
+
+def enable() -> Tracer:
+    """Start recording spans, returning the tracer that holds them"""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer()
+    return _tracer
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, **attrs):
+    """A context manager timing the code inside it as a span named name,
+    nested under the current span. A no-op unless tracing is enabled."""
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, **attrs)
+
+
+def carry(coro):
+    """Wrap coro so that it runs with the span current now as its parent.
+    Coroutines handed to another thread's event loop do not otherwise
+    inherit the caller's span."""
+    if _tracer is None:
+        return coro
+    parent = _current.get()
+
+    async def run():
+        _current.set(parent)
+        return await coro
+    return run()
+
+
+def current():
+    """The span code is running in, or None"""
+    return _current.get()
+
+
+def write(path: str):
+    """Save the spans recorded so far as Chrome trace-event JSON"""
+    if _tracer is not None:
+        _tracer.write(path)